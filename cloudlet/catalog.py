@@ -0,0 +1,240 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Cached Glance and Nova catalog shared by all dashboard processes.
+
+Listings are stored through Django's cache framework, keyed per tenant,
+per endpoint and per call arguments. Only plain dicts are cached, the API
+objects are rebuilt on read. Every endpoint has a generation counter, and
+``invalidate`` bumps it so all tenants see the change on their next read.
+The status polling of table rows bypasses the cache, so rows still in
+progress do not lag behind.
+
+The base VM of every overlay requested from the dashboard is recorded
+in the same cache, see ``set_overlay_origin``, and so is the metadata of
+remote overlays with their HTTP validators, see ``set_overlay_meta``.
+
+Configured with the ``CLOUDLET_CATALOG_CACHE`` setting::
+
+    CLOUDLET_CATALOG_CACHE = {
+        'enabled': True,
+        'cache_alias': 'default',
+        'timeouts': {'flavors': 300, 'images': 30,
+                     'overlay_origins': 86400},
+    }
+"""
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from novaclient.v2 import flavors as nova_flavors
+
+from openstack_dashboard import api
+
+
+LOG = logging.getLogger(__name__)
+
+FLAVORS = 'flavors'
+IMAGES = 'images'
+OVERLAY_ORIGINS = 'overlay_origins'
+
+KEY_PREFIX = 'cloudlet:catalog'
+
+
+def get_config():
+    config = {'enabled': True,
+              'cache_alias': 'default',
+              'timeouts': {FLAVORS: 300, IMAGES: 30,
+                           OVERLAY_ORIGINS: 86400}}
+    custom = dict(getattr(settings, 'CLOUDLET_CATALOG_CACHE', {}))
+    timeouts = dict(config['timeouts'])
+    timeouts.update(custom.pop('timeouts', {}))
+    config.update(custom)
+    config['timeouts'] = timeouts
+    return config
+
+
+class CachedResource(dict):
+    """Read-only stand-in for a client resource rebuilt from the cache."""
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    @property
+    def _info(self):
+        return dict(self)
+
+    def to_dict(self):
+        return dict(self)
+
+
+def _resource_info(obj):
+    resource = getattr(obj, '_apiresource', obj)
+    info = getattr(resource, '_info', None)
+    if info is None:
+        info = dict(resource)
+    return dict(info)
+
+
+def _get_cache():
+    return caches[get_config()['cache_alias']]
+
+
+def _generation_key(endpoint):
+    return '%s:%s:generation' % (KEY_PREFIX, endpoint)
+
+
+def get_generation(endpoint):
+    if not get_config()['enabled']:
+        return None
+    try:
+        return _get_generation(_get_cache(), endpoint)
+    except Exception:
+        LOG.debug("Unable to read the catalog generation.", exc_info=True)
+        return None
+
+
+def _get_generation(cache, endpoint):
+    generation = cache.get(_generation_key(endpoint))
+    if generation is None:
+        generation = 1
+        cache.add(_generation_key(endpoint), generation, None)
+    return generation
+
+
+def _data_key(cache, request, endpoint, params):
+    digest = hashlib.md5(repr(sorted(params.items()))).hexdigest()
+    return '%s:%s:%s:%s:%s' % (KEY_PREFIX, endpoint,
+                               _get_generation(cache, endpoint),
+                               request.user.tenant_id, digest)
+
+
+def _get_or_load(request, endpoint, params, loader):
+    config = get_config()
+    if not config['enabled']:
+        return loader()
+    cache = _get_cache()
+    key = _data_key(cache, request, endpoint, params)
+    data = cache.get(key)
+    if data is None:
+        data = loader()
+        cache.set(key, data, config['timeouts'].get(endpoint, 30))
+    return data
+
+
+def invalidate(*endpoints):
+    """Drop the cached listings of the given endpoints for all tenants."""
+    try:
+        cache = _get_cache()
+        for endpoint in endpoints or (FLAVORS, IMAGES):
+            key = _generation_key(endpoint)
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 2, None)
+    except Exception:
+        LOG.exception("Unable to invalidate the cloudlet catalog cache.")
+
+
+def flavor_list(request):
+    def load():
+        return [_resource_info(flavor)
+                for flavor in api.nova.flavor_list(request)]
+
+    infos = _get_or_load(request, FLAVORS, {}, load)
+    # Full novaclient flavors, get_keys() and the extension attributes
+    # such as is_public and ephemeral work as on uncached ones.
+    manager = api.nova.novaclient(request).flavors
+    return [nova_flavors.Flavor(manager, info, loaded=True)
+            for info in infos]
+
+
+def image_list_detailed(request, **kwargs):
+    def load():
+        images, more, prev = api.glance.image_list_detailed(request,
+                                                            **kwargs)
+        images = list(images)
+        wrapped = bool(images) and isinstance(images[0], api.glance.Image)
+        return [_resource_info(im) for im in images], more, prev, wrapped
+
+    infos, more, prev, wrapped = _get_or_load(request, IMAGES, kwargs, load)
+    images = [CachedResource(info) for info in infos]
+    if wrapped:
+        images = [api.glance.Image(image) for image in images]
+    return images, more, prev
+
+
+def _overlay_origin_key(overlay_name):
+    return '%s:overlay-origin:%s' % (KEY_PREFIX, overlay_name)
+
+
+def set_overlay_origin(overlay_name, origin):
+    """Remember the base VM an overlay is created from, by overlay name.
+
+    Overlay images are created by Nova after the request returns, so their
+    ID is not known yet. The record is moved to the overlay image once it
+    is seen, see ``utils.store_overlay_origin``. Otherwise it expires
+    after the ``overlay_origins`` timeout, or is dropped when the overlay
+    image is deleted.
+    """
+    timeout = get_config()['timeouts'][OVERLAY_ORIGINS]
+    try:
+        _get_cache().set(_overlay_origin_key(overlay_name), origin, timeout)
+    except Exception:
+        LOG.exception("Unable to record the origin of %s.", overlay_name)
+
+
+def delete_overlay_origin(overlay_name):
+    try:
+        _get_cache().delete(_overlay_origin_key(overlay_name))
+    except Exception:
+        LOG.exception("Unable to drop the origin of %s.", overlay_name)
+
+
+def get_overlay_origin(overlay_name):
+    try:
+        return _get_cache().get(_overlay_origin_key(overlay_name))
+    except Exception:
+        LOG.debug("Unable to read the origin of %s.", overlay_name,
+                  exc_info=True)
+        return None
+
+
+def _overlay_meta_key(overlay_url):
+    digest = hashlib.md5(overlay_url.encode('utf-8')).hexdigest()
+    return '%s:overlay-meta:%s' % (KEY_PREFIX, digest)
+
+
+def get_overlay_meta(overlay_url):
+    """Return the cached metadata entry of the overlay at ``overlay_url``."""
+    try:
+        entry = _get_cache().get(_overlay_meta_key(overlay_url))
+    except Exception:
+        LOG.debug("Unable to read the metadata of %s.", overlay_url,
+                  exc_info=True)
+        return None
+    # Guard against digest collisions.
+    if entry is not None and entry.get('url') != overlay_url:
+        return None
+    return entry
+
+
+def set_overlay_meta(overlay_url, entry, timeout):
+    entry = dict(entry, url=overlay_url)
+    try:
+        _get_cache().set(_overlay_meta_key(overlay_url), entry, timeout)
+    except Exception:
+        LOG.exception("Unable to cache the metadata of %s.", overlay_url)
@@ -18,12 +18,16 @@ from urlparse import urlparse
 from openstack_dashboard.api.base import url_for
 
 
+def get_overlay_name(instance_id):
+    return "overlay-" + str(instance_id)
+
+
 def request_create_overlay(request, instance_id):
     token = request.user.token.id
     management_url = url_for(request, 'compute')
     end_point = urlparse(management_url)
 
-    overlay_name = "overlay-" + str(instance_id)
+    overlay_name = get_overlay_name(instance_id)
     params = json.dumps({
         "cloudlet-overlay-finish": {
             "overlay-name": overlay_name
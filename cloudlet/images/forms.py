@@ -12,7 +12,6 @@
 
 import logging
 import os
-import shutil
 
 from django.conf import settings
 from django.forms import ValidationError
@@ -26,15 +25,17 @@ from horizon import messages
 from openstack_dashboard import api
 from openstack_dashboard import policy
 
+from openstack_dashboard.dashboards.project.cloudlet import catalog
+from openstack_dashboard.dashboards.project.cloudlet import jobs
+from openstack_dashboard.dashboards.project.cloudlet import uploads
 from openstack_dashboard.dashboards.project.cloudlet import utils
 
 
 LOG = logging.getLogger(__name__)
 
 
-def create_image_metadata(data, name, path, glance_ref=None):
+def create_image_metadata(data, name, glance_ref=None):
     meta = {'name': name,
-            'data': open(path, "rb"),
             'disk_format': 'raw',
             'container_format': 'bare',
             'min_disk': (data['minimum_disk'] or 0),
@@ -69,6 +70,10 @@ def create_image_metadata(data, name, path, glance_ref=None):
     return meta
 
 
+def create_image(request, meta):
+    return api.glance.image_create(request, **meta)
+
+
 class ImportBaseForm(forms.SelfHandlingForm):
     name = forms.CharField(
         max_length=255,
@@ -80,6 +85,9 @@ class ImportBaseForm(forms.SelfHandlingForm):
         label=_("Image File"),
         help_text=("A local image to upload."),
         required=False)
+    # Set by the browser once the archive was sent with the chunked
+    # upload API, image_file is empty then.
+    upload_id = forms.CharField(widget=HiddenInput(), required=False)
     is_public = forms.BooleanField(
         label=_("Public"),
         required=False,
@@ -128,6 +136,13 @@ class ImportBaseForm(forms.SelfHandlingForm):
         # The image_file key can be missing based on particular upload
         # conditions. Code defensively for it here...
         image_file = data.get('image_file', None)
+        if data.get('upload_id'):
+            try:
+                image_file = uploads.get_path(self.request.user.tenant_id,
+                                              data['upload_id'])
+            except uploads.UploadError as e:
+                raise ValidationError({'image_file': [unicode(e), ]})
+            data['image_file'] = image_file
         if not image_file:
             msg = _("An image file or an external location must be specified.")
             raise ValidationError({'image_file': [msg, ]})
@@ -140,8 +155,10 @@ class ImportBaseForm(forms.SelfHandlingForm):
                     msg = _('Image File is not valid, no manifest file')
                     raise ValidationError({'image_file': [msg, ]})
                 else:
-                    base_hashvalue = tree.get('hash_value')
+                    base_hashvalue = basevms.hash_value
                     data['base_hashvalue'] = base_hashvalue
+                    # handle() reuses the opened archive and manifest.
+                    data['basevm_package'] = basevms
                     matching_base = basevms.is_exist(self.request, base_hashvalue)
                     if matching_base is not None:
                         msg = _("Base VM exists : UUID(%s)" % matching_base.id)
@@ -154,16 +171,38 @@ class ImportBaseForm(forms.SelfHandlingForm):
 
     def handle(self, request, data):
         # TODO: Useing Cloudlet APIs not using Class.
-        basevms = utils.BaseVMs()
+        basevms = data.get('basevm_package') or utils.BaseVMs()
+        # The import runs with the token of this request.
+        try:
+            jobs.check_token(request,
+                             jobs.get_config()['min_token_lifetime'])
+        except jobs.TokenExpired:
+            messages.error(request, _('Your session expires too soon to '
+                                      'import a Base VM, log in again.'))
+            basevms.cleanup()
+            return False
         if basevms.zipfile(data['image_file']):
-            tree = basevms.xml_data()
-            basevms_path = basevms.path(tree)
-            temp_dir = basevms.unzip()
-        # Get Base VM CPU count, memory size(MB) and disk size(GB)
+            basevms_path = basevms.path()
+        # Get Base VM CPU count, memory size(MB) and disk size(GB), only the
+        # headers are read so this is quick even for large archives.
         qemu_mem = utils.QemuMemory()
-        libvirt_xml_str = qemu_mem.libvirt_xml(os.path.join(temp_dir, basevms_path['memory']))
-        cpu_count, memory_size_mb = qemu_mem.get_resource_size(libvirt_xml_str)
-        disk_gb = basevms.min_disk(os.path.join(temp_dir, basevms_path['disk']))
+        memory = basevms.open_member(basevms_path['memory'])
+        try:
+            libvirt_xml_str, cpu_count, memory_size_mb = \
+                qemu_mem.read_header(memory)
+        finally:
+            memory.close()
+        # min_disk must cover the logical size, however sparse the disk is.
+        disk_size = basevms.member_size(basevms_path['disk'])
+        disk_gb = basevms.size_to_gb(disk_size)
+        allocated = basevms.member_allocated_size(basevms_path['disk'])
+        if allocated is None:
+            # Streamed disks are measured while they are uploaded.
+            LOG.info("Base VM disk %s: %d bytes logical",
+                     basevms_path['disk'], disk_size)
+        else:
+            LOG.info("Base VM disk %s: %d bytes logical, %d bytes allocated",
+                     basevms_path['disk'], disk_size, allocated)
         data['minimum_ram'] = memory_size_mb
         data['minimum_disk'] = disk_gb
         # Check Base VM spec (CPU core, memory size and disk size) is exitsing Flavor list
@@ -181,51 +220,155 @@ class ImportBaseForm(forms.SelfHandlingForm):
                                        cpu_count,
                                        disk_gb,
                                        is_public=True)
+                catalog.invalidate(catalog.FLAVORS)
                 msg = "Create new flavor %s with (cpu:%d, memory:%d, disk:%d)" % \
                       (flavor_name, cpu_count, memory_size_mb, disk_gb)
                 LOG.info(msg)
 
+        # The images are created and uploaded by a background job, the
+        # request returns as soon as the archive is handed over.
         try:
-            # Create image metadata and Upload image to glance without disk image
-            glance_ref = {'base_resource_xml_str': libvirt_xml_str.replace("\n", "")}
-            for key, value in basevms_path.iteritems():
-                name = data['name'] + "-" + key
-                path = os.path.join(temp_dir, value)
-                if key == 'disk':
-                    continue
-                meta = create_image_metadata(data, name, path)
-                image = api.glance.image_create(request, **meta)
-                glance_ref[image.properties.get("cloudlet_type", None)] = image.id
-
-            # Create disk image metadata and Upload image
-            disk_name = data['name'] + "-disk"
-            disk_path = os.path.join(temp_dir, basevms_path['disk'])
-            meta = create_image_metadata(data, disk_name, disk_path, glance_ref)
-            image = api.glance.image_create(request, **meta)
-            # All Base VM zip file upload to glance success
-            messages.info(request,
-                          _('Your image %s has been queued for creation.') %
-                          meta['name'])
-            # Delete Base VM unzip temp directory
-            dirpath = os.path.dirname(os.path.join(temp_dir, basevms_path['disk']))
-            if os.path.exists(dirpath):
-                shutil.rmtree(dirpath)
-            return image
-        except Exception as e:
-            msg = _('Unable to create new image')
-            if hasattr(e, 'code') and e.code == 400:
-                if "Invalid disk format" in e.details:
-                    msg = _('Unable to create new image: Invalid disk format '
-                            '%s for image.') % meta['disk_format']
-                elif "Image name too long" in e.details:
-                    msg = _('Unable to create new image: Image name too long.')
-                elif "not supported" in e.details:
-                    msg = _('Unable to create new image: URL scheme not '
-                            'supported.')
-
-            exceptions.handle(request, msg)
-
+            store = jobs.get_store()
+            job_id = store.create(request.user.tenant_id, jobs.IMPORT_BASE_VM,
+                                  data['name'], data.get('is_public', False))
+            archive_path = jobs.keep_upload(data['image_file'], job_id)
+            basevms.cleanup()
+            if data.get('upload_id'):
+                uploads.discard(data['upload_id'])
+            job_data = dict((key, value) for key, value in data.items()
+                            if key not in ('image_file', 'basevm_package',
+                                           'upload_id'))
+            jobs.submit(import_base_vm, request, job_data, archive_path,
+                        libvirt_xml_str, job_id)
+        except Exception:
+            basevms.cleanup()
+            exceptions.handle(request, _('Unable to start the import of '
+                                         'Base VM %s.') % data['name'])
             return False
+        messages.info(request,
+                      _('Base VM %(name)s is being imported (job %(job)s).') %
+                      {'name': data['name'], 'job': job_id})
+        return job_id
+
+
+def _import_error_message(e):
+    if isinstance(e, jobs.TokenExpired):
+        return _('Unable to create new image: the session expired, log in '
+                 'again and import the Base VM again.')
+    msg = _('Unable to create new image')
+    if hasattr(e, 'code') and e.code == 400:
+        if "Invalid disk format" in e.details:
+            msg = _('Unable to create new image: Invalid disk format '
+                    'raw for image.')
+        elif "Image name too long" in e.details:
+            msg = _('Unable to create new image: Image name too long.')
+        elif "not supported" in e.details:
+            msg = _('Unable to create new image: URL scheme not '
+                    'supported.')
+    return msg
+
+
+def import_base_vm(request, data, archive_path, libvirt_xml_str, job_id):
+    """Create and upload the images of a base VM, run as a background job.
+
+    The stage and upload progress are recorded in the job table, which
+    is the only way the outcome reaches the user. Returns the disk image
+    ID with the logical size, allocated size and bytes sent of all the
+    components, which are also stored in the job row, and the upload
+    stats of every component. Returns None when the import failed.
+    """
+    store = jobs.get_store()
+    import_config = utils.get_import_config()
+    workers = import_config['upload_workers']
+    basevms = utils.BaseVMs()
+    created = []
+    try:
+        # The job may have waited for a worker, the images must not be
+        # created with a token which expires before the uploads start.
+        jobs.check_token(request, 60)
+        basevms.zipfile(archive_path)
+        basevms_path = basevms.path()
+        # Without streaming, extract the whole archive to a temp
+        # directory first and upload from there.
+        if not import_config['streaming']:
+            store.update(job_id, stage=jobs.STAGE_EXTRACTING)
+            basevms.unzip()
+
+        # Create the image metadata of memory, disk hash and memory hash
+        # concurrently, the disk image needs their IDs in glance_ref.
+        store.update(job_id, stage=jobs.STAGE_CREATING)
+        glance_ref = {'base_resource_xml_str': libvirt_xml_str.replace("\n", "")}
+        side_members = [(key, value)
+                        for key, value in basevms_path.iteritems()
+                        if key != 'disk']
+        metas = [create_image_metadata(data, data['name'] + "-" + key)
+                 for key, value in side_members]
+        results = utils.run_parallel(create_image,
+                                     [(request, meta) for meta in metas],
+                                     workers)
+        created = [image for image, error in results if error is None]
+        for image, error in results:
+            if error is not None:
+                raise error
+        components = []
+        for (key, value), (image, error) in zip(side_members, results):
+            glance_ref[image.properties.get("cloudlet_type", None)] = image.id
+            components.append((key, image.id, value))
+
+        # Create disk image metadata, the disk data is uploaded along
+        # with the other components.
+        disk_name = data['name'] + "-disk"
+        meta = create_image_metadata(data, disk_name, glance_ref)
+        image = create_image(request, meta)
+        created.append(image)
+        components.append(('disk', image.id, basevms_path['disk']))
+
+        # The manifest hash value is the SHA-256 of the disk image and
+        # the memory_hash member lists the SHA-256 of every page of the
+        # memory snapshot, both are checked on the bytes streamed to Glance.
+        verifiers = {}
+        if import_config['verify_integrity']:
+            verifiers['disk'] = utils.Sha256Verifier(data['base_hashvalue'])
+            hash_list = basevms.memory_hash_list()
+            if hash_list is None:
+                raise utils.IntegrityError("Invalid memory hash list")
+            verifiers['memory'] = utils.HashListVerifier(hash_list)
+        jobs.check_token(request)
+        store.update(job_id, stage=jobs.STAGE_UPLOADING,
+                     bytes_total=sum(basevms.member_size(value)
+                                     for key, image_id, value in components))
+        # run_uploads deletes the images itself when an upload fails.
+        created = []
+        progress = jobs.ProgressReporter(store, job_id)
+        stats = utils.run_uploads(
+            request,
+            [(key, image_id, basevms.open_member(value), verifiers.get(key))
+             for key, image_id, value in components],
+            workers, progress)
+        progress.flush()
+        catalog.invalidate(catalog.IMAGES)
+        sizes = {'logical_size': sum(s['logical_size'] for s in stats),
+                 'allocated_size': sum(s['allocated_size'] for s in stats),
+                 'bytes_sent': sum(s['bytes'] for s in stats)}
+        store.finish(job_id, image.id, **sizes)
+        LOG.info("Base VM import job %s done: %d bytes logical, %d bytes "
+                 "allocated, %d bytes sent", job_id, sizes['logical_size'],
+                 sizes['allocated_size'], sizes['bytes_sent'])
+        return dict(sizes, image_id=image.id, uploads=stats)
+    except Exception as e:
+        LOG.exception("Base VM import job %s failed", job_id)
+        for image in created:
+            try:
+                api.glance.image_delete(request, image.id)
+            except Exception:
+                LOG.warning("Unable to delete image %s", image.id)
+        store.fail(job_id, unicode(_import_error_message(e)))
+    finally:
+        basevms.cleanup()
+        try:
+            os.remove(archive_path)
+        except OSError:
+            LOG.warning("Unable to remove %s", archive_path)
 
 
 class UpdateImageForm(forms.SelfHandlingForm):
@@ -245,10 +388,18 @@ class UpdateImageForm(forms.SelfHandlingForm):
     def handle(self, request, data):
         image_id = data['image_id']
         error_updating = _('Unable to update image "%s".')
+        # The recorded base VM of an overlay is keyed by its current name.
+        try:
+            utils.store_overlay_origin(request,
+                                       api.glance.image_get(request, image_id))
+        except Exception:
+            LOG.warning("Unable to store the base VM of image %s", image_id,
+                        exc_info=True)
         meta = create_image_metadata(data)
 
         try:
             image = api.glance.image_update(request, image_id, **meta)
+            catalog.invalidate(catalog.IMAGES)
             messages.success(request, _('Image was successfully updated.'))
             return image
         except Exception:
@@ -22,6 +22,10 @@ from horizon import tables
 from horizon.utils.memoized import memoized
 
 from openstack_dashboard import api
+from openstack_dashboard.dashboards.project.cloudlet import catalog
+from openstack_dashboard.dashboards.project.cloudlet import jobs
+from openstack_dashboard.dashboards.project.cloudlet import overlay_cache
+from openstack_dashboard.dashboards.project.cloudlet import utils
 
 
 class DownloadImage(tables.LinkAction):
@@ -78,6 +82,29 @@ class ResumeBaseVM(tables.LinkAction):
                             "source_id": self.table.get_object_id(datum)})
         return "?".join([base_url, params])
 
+    def allowed(self, request, image=None):
+        # Rows of running import jobs have no image to resume yet.
+        return not getattr(image, 'is_import_job', False)
+
+
+class SynthesizeOverlay(tables.LinkAction):
+    name = "synthesize"
+    verbose_name = _("Synthesize")
+    url = "horizon:project:cloudlet:instances:synthesis"
+    classes = ("btn-launch", "ajax-modal")
+
+    def allowed(self, request, image=None):
+        # Compute nodes fetch the overlay from the published overlay cache.
+        if image and overlay_cache.is_published():
+            return image.status in ("active",)
+        return False
+
+    def get_link_url(self, datum):
+        base_url = reverse(self.url)
+        params = urlencode({"source_type": "image",
+                            "overlay_image_id": self.table.get_object_id(datum)})
+        return "?".join([base_url, params])
+
 
 class DeleteImage(tables.DeleteAction):
     # NOTE: The bp/add-batchactions-help-text
@@ -112,7 +139,13 @@ class DeleteImage(tables.DeleteAction):
         return True
 
     def delete(self, request, obj_id):
+        image = self.table.get_object_by_id(obj_id)
         api.glance.image_delete(request, obj_id)
+        catalog.invalidate(catalog.IMAGES)
+        utils.BASEVM_INDEX.invalidate()
+        properties = getattr(image, 'properties', None) or {}
+        if properties.get('cloudlet_type') == 'cloudlet_overlay':
+            catalog.delete_overlay_origin(image.name)
 
 
 def filter_tenants():
@@ -137,17 +170,58 @@ def get_image_categories(im, user_tenant_id):
     return categories
 
 
+def get_image_link(image):
+    if getattr(image, 'is_import_job', False):
+        return None
+    return reverse("horizon:project:images:images:detail", args=(image.id,))
+
+
 def get_image_type(image):
     return getattr(image, "properties", {}).get("image_type", _("Image"))
 
 
 class UpdateRow(tables.Row):
-    ajax = True
+    # Pending rows are refreshed together by BatchRowUpdateView instead of
+    # one request per row, see _batch_row_update.html.
+    ajax = False
 
     def get_data(self, request, image_id):
         image = api.glance.image_get(request, image_id)
         return image
 
+    def get_batch_data(self, request, image_ids):
+        """Return the pending images and import jobs keyed by their ID.
+
+        A finished import job is replaced by the disk image it created.
+        Images and jobs confirmed gone map to None, the ones which could
+        not be looked up are left out. The recorded base VM of a new
+        overlay is stored on its image.
+        """
+        image_ids = set(image_ids)
+        job_ids = set(filter(jobs.is_job_id, image_ids))
+        data = utils.get_images_by_id(request, image_ids - job_ids,
+                                      use_cache=False, with_gone=True)
+        for image in data.values():
+            if image is not None:
+                utils.store_overlay_origin(request, image)
+        finished = {}
+        store = jobs.get_store()
+        for job_id in job_ids:
+            job = store.get(job_id)
+            if job is None or job['tenant_id'] != request.user.tenant_id:
+                data[job_id] = None
+            elif job['status'] == jobs.DONE:
+                finished[job_id] = job['image_id']
+            else:
+                data[job_id] = jobs.Job(job)
+        if finished:
+            images = utils.get_images_by_id(request, finished.values(),
+                                            use_cache=False, with_gone=True)
+            for job_id, image_id in finished.items():
+                if image_id in images:
+                    data[job_id] = images[image_id]
+        return data
+
     def load_cells(self, image=None):
         super(UpdateRow, self).load_cells(image)
         # Tag the row with the image category for client-side filtering.
@@ -179,7 +253,7 @@ class BaseVMsTable(tables.DataTable):
                                       u"Deactivated")),
     )
     name = tables.Column("name",
-                         link=("horizon:project:images:images:detail"),
+                         link=get_image_link,
                          verbose_name=_("Base VM Images"))
     # image_type = tables.Column(get_image_type,
     #                            verbose_name=_("Type"),
@@ -196,6 +270,8 @@ class BaseVMsTable(tables.DataTable):
 
     class Meta:
         name = "images"
+        pagination_param = "images_marker"
+        prev_pagination_param = "prev_images_marker"
         row_class = UpdateRow
         status_columns = ["status"]
         verbose_name = _("Base VMs")
@@ -242,9 +318,12 @@ class VMOverlaysTable(tables.DataTable):
 
     class Meta:
         name = "overlays"
+        pagination_param = "overlays_marker"
+        prev_pagination_param = "prev_overlays_marker"
         row_class = UpdateRow
         status_columns = ["status"]
         verbose_name = _("VM Overlays")
         hidden_title = False
         table_actions = (DeleteImage,)
-        row_actions = (DownloadImage, EditImage, DeleteImage,)
+        row_actions = (SynthesizeOverlay, DownloadImage, EditImage,
+                       DeleteImage,)
@@ -19,4 +19,14 @@ urlpatterns = [
     url(r'^import/$', views.ImportBaseView.as_view(), name='import'),
     url(r'^(?P<image_id>[^/]+)/update/$', views.UpdateView.as_view(), name='update'),
     url(r'^download/$', views.download_vm_overlay, name='download'),
+    url(r'^images/rows/$', views.BatchRowUpdateView.as_view(),
+        name='batch_update'),
+    url(r'^images/jobs/(?P<job_id>[^/]+)/$', views.ImportJobView.as_view(),
+        name='job_status'),
+    url(r'^images/uploads/$', views.ChunkedUploadView.as_view(),
+        name='upload_create'),
+    url(r'^images/exists/$', views.BaseVMExistsView.as_view(),
+        name='basevm_exists'),
+    url(r'^images/uploads/(?P<upload_id>[^/]+)/$',
+        views.UploadChunkView.as_view(), name='upload_chunk'),
 ]
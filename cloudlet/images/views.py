@@ -10,22 +10,34 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import logging
+import re
+
 from django import http
 from django import shortcuts
 from django.core.urlresolvers import reverse
 from django.core.urlresolvers import reverse_lazy
 from django.utils.translation import ugettext_lazy as _
+from django.views import generic
 
 from horizon import exceptions
 from horizon import forms
 from horizon import messages
-from horizon import workflows
 from horizon.utils import memoized
 
 from openstack_dashboard import api
+from openstack_dashboard.dashboards.project.cloudlet import jobs
+from openstack_dashboard.dashboards.project.cloudlet import overlay_cache
+from openstack_dashboard.dashboards.project.cloudlet import uploads
+from openstack_dashboard.dashboards.project.cloudlet import utils
 
 from openstack_dashboard.dashboards.project.cloudlet.images \
     import forms as project_forms
+from openstack_dashboard.dashboards.project.cloudlet.images \
+    import tables as project_tables
+
+
+LOG = logging.getLogger(__name__)
 
 
 class ImportBaseView(forms.ModalFormView):
@@ -60,6 +72,7 @@ class ImportBaseView(forms.ModalFormView):
         context = super(ImportBaseView, self).get_context_data(**kwargs)
         upload_mode = api.glance.get_image_upload_mode()
         context['image_upload_enabled'] = upload_mode != 'off'
+        context['manifest_filename'] = utils.BaseVMPackage.MANIFEST_FILENAME
         return context
 
 
@@ -110,16 +123,201 @@ class UpdateView(forms.ModalFormView):
         return data
 
 
+class BatchRowUpdateView(generic.View):
+    """Render the pending rows of the image tables in a single response.
+
+    Takes the image IDs of every table as repeated ``<table name>``
+    parameters, looks them all up with one Glance listing and returns a
+    JSON object mapping table names to ``{image ID: row HTML}``. An empty
+    string means the image no longer exists. Images which could not be
+    looked up are left out, so their rows keep polling. Rows of import
+    jobs are requested by job ID, and replaced by their image once it
+    exists.
+    """
+    table_classes = (project_tables.BaseVMsTable,
+                     project_tables.VMOverlaysTable)
+    max_rows = 200
+
+    def get(self, request, *args, **kwargs):
+        requested = {}
+        for table_class in self.table_classes:
+            name = table_class._meta.name
+            image_ids = [image_id for image_id
+                         in request.GET.getlist(name) if image_id]
+            requested[name] = image_ids[:self.max_rows]
+
+        all_ids = set()
+        for image_ids in requested.values():
+            all_ids.update(image_ids)
+        images = {}
+        if all_ids:
+            row_class = project_tables.UpdateRow
+            table = self.table_classes[0](request)
+            try:
+                images = row_class(table).get_batch_data(request, all_ids)
+            except Exception:
+                LOG.warning("Unable to refresh the image rows.",
+                            exc_info=True)
+
+        rows = {}
+        for table_class in self.table_classes:
+            name = table_class._meta.name
+            table = table_class(request)
+            rows[name] = {}
+            for image_id in requested[name]:
+                if image_id not in images:
+                    continue
+                if images[image_id] is None:
+                    rows[name][image_id] = ''
+                    continue
+                try:
+                    row = table._meta.row_class(table)
+                    row.load_cells(images[image_id])
+                    rows[name][image_id] = row.render()
+                except Exception:
+                    LOG.warning("Unable to render the row of image %s.",
+                                image_id, exc_info=True)
+        return http.JsonResponse({'rows': rows})
+
+
+class ImportJobView(generic.View):
+    """Report the progress of a Base VM import job as JSON."""
+    def get(self, request, job_id):
+        job = jobs.get_store().get(job_id)
+        if job is None or job['tenant_id'] != request.user.tenant_id:
+            return http.JsonResponse({'error': 'Job not found'}, status=404)
+        return http.JsonResponse(
+            dict((key, job[key]) for key in ('id', 'name', 'status', 'stage',
+                                             'message', 'image_id',
+                                             'bytes_total', 'bytes_done',
+                                             'throughput', 'logical_size',
+                                             'allocated_size',
+                                             'bytes_sent')))
+
+
+class BaseVMExistsView(generic.View):
+    """Tell whether a Base VM with the given manifest ``hash_value`` exists.
+
+    The browser reads the hash value out of the archive manifest and asks
+    here before uploading an archive which would be refused.
+    """
+    def get(self, request):
+        hash_value = request.GET.get('hash_value', '')
+        if not re.match(r'^[0-9a-fA-F]{64}$', hash_value):
+            return http.JsonResponse({'error': 'Invalid hash value'},
+                                     status=400)
+        try:
+            image = utils.find_basevm_by_sha256(request, hash_value)
+        except Exception:
+            return http.JsonResponse({'error': 'Unable to retrieve images'},
+                                     status=503)
+        if image is None:
+            return http.JsonResponse({'exists': False})
+        return http.JsonResponse({'exists': True,
+                                  'id': image.id,
+                                  'name': getattr(image, 'name', None)})
+
+
+def _upload_error(error):
+    return http.JsonResponse({'error': str(error), 'offset': error.offset},
+                             status=error.status)
+
+
+class ChunkedUploadView(generic.View):
+    """Start a chunked upload, takes the ``filename`` and ``size``."""
+    def post(self, request):
+        try:
+            upload = uploads.create(request.user.tenant_id,
+                                    request.POST.get('filename'),
+                                    request.POST.get('size'))
+        except uploads.UploadError as e:
+            return _upload_error(e)
+        return http.JsonResponse(upload, status=201)
+
+
+class UploadChunkView(generic.View):
+    """Report the offset of a chunked upload, or append a chunk to it.
+
+    A chunk is the raw body of a PUT with its ``offset`` as a parameter,
+    and optionally its SHA-256 in the ``X-Chunk-SHA256`` header.
+    """
+    def get(self, request, upload_id):
+        try:
+            return http.JsonResponse(
+                uploads.status(request.user.tenant_id, upload_id))
+        except uploads.UploadError as e:
+            return _upload_error(e)
+
+    def put(self, request, upload_id):
+        try:
+            offset = int(request.GET.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return http.JsonResponse({'error': 'Invalid offset'}, status=400)
+        try:
+            upload = uploads.write_chunk(
+                request.user.tenant_id, upload_id, offset, length, request,
+                request.META.get('HTTP_X_CHUNK_SHA256'))
+        except uploads.UploadError as e:
+            return _upload_error(e)
+        return http.JsonResponse(upload)
+
+
 def download_vm_overlay(request):
+    """Stream a VM overlay, a single byte range can be asked for.
+
+    ``If-Range`` is checked against the image checksum, which is sent as
+    the ETag, so a resumed download never mixes two versions. Overlays
+    are served from the local overlay cache when they are in it, full
+    downloads from Glance fill it.
+    """
+    image_id = request.GET.get('image_id', None)
+    image_name = request.GET.get('image_name', None)
+    if image_id is None:
+        return http.HttpResponseBadRequest(_('No image_id given.'))
     try:
-        image_id = request.GET.get('image_id', None)
-        image_name = request.GET.get('image_name', None)
-        if image_id is None:
-            raise
-        client = api.glance.glanceclient(request)
-
-        body = client.images.data(image_id)
-        response = http.HttpResponse(body, content_type="application/octet-stream")
+        image = api.glance.image_get(request, image_id)
+        size = getattr(image, 'size', None)
+        checksum = getattr(image, 'checksum', None)
+        etag = '"%s"' % checksum if checksum else None
+
+        byte_range = None
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if range_header and size is not None and \
+                (if_range is None or if_range == etag):
+            try:
+                byte_range = utils.parse_byte_range(range_header, size)
+            except ValueError:
+                response = http.HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+
+        cache = overlay_cache.get_cache()
+        cached = None
+        if cache is not None and checksum and size is not None:
+            cached = cache.lookup(image_id, checksum, size)
+
+        if cached is not None:
+            response = overlay_cache.file_response(cached, byte_range, size)
+        elif byte_range is not None:
+            start, end = byte_range
+            body = utils.iter_image_data(request, image_id, start, end)
+            response = http.StreamingHttpResponse(
+                body, status=206, content_type="application/octet-stream")
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+        else:
+            body = utils.iter_image_data(request, image_id)
+            if cache is not None and checksum and size is not None:
+                body = cache.fill(image_id, checksum, size, body)
+            response = http.StreamingHttpResponse(
+                body, content_type="application/octet-stream")
+            if size is not None:
+                response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes'
+        if etag:
+            response['ETag'] = etag
         response['Content-Disposition'] = 'attachment; filename="%s"' % image_name
         return response
     except Exception, e:
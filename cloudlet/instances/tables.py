@@ -8,6 +8,7 @@ from django.utils.translation import pgettext_lazy
 from django.utils.translation import string_concat
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ungettext_lazy
+from novaclient import exceptions as nova_exceptions
 import six
 
 from horizon import tables
@@ -18,6 +19,7 @@ from horizon.utils import filters
 
 from openstack_dashboard import api
 from openstack_dashboard import policy
+from openstack_dashboard.dashboards.project.cloudlet import catalog
 from openstack_dashboard.dashboards.project.cloudlet import cloudlet_api
 from openstack_dashboard.dashboards.project.cloudlet import utils
 from openstack_dashboard.dashboards.project.instances.workflows \
@@ -28,6 +30,10 @@ LOG = logging.getLogger(__name__)
 
 ACTIVE_STATES = ("ACTIVE",)
 
+# Up to this many pending rows are refreshed with one server GET each,
+# more of them with a listing of the project's servers.
+BATCH_GET_THRESHOLD = 10
+
 POWER_STATES = {
     0: "NO STATE",
     1: "RUNNING",
@@ -41,6 +47,11 @@ POWER_STATES = {
     9: "BUILDING",
 }
 
+CLOUDLET_TYPE_DISPLAY = {
+    'cloudlet_base_disk': _("Resumed Base VM"),
+    'cloudlet_overlay': _("Provisioned VM"),
+}
+
 PAUSE = 0
 UNPAUSE = 1
 SUSPEND = 0
@@ -110,7 +121,7 @@ class CreateOverlayAction(tables.BatchAction):
     def allowed(self, request, instance=None):
         is_active = instance.status in ACTIVE_STATES
         is_resumed_base = False
-        cloudlet_type = utils.get_cloudlet_type(instance)
+        cloudlet_type = utils.get_cloudlet_type(instance, request)
         if cloudlet_type == 'cloudlet_base_disk':
             is_resumed_base = True
 
@@ -118,6 +129,10 @@ class CreateOverlayAction(tables.BatchAction):
 
     def action(self, request, obj_id):
         ret_dict = cloudlet_api.request_create_overlay(request, obj_id)
+        # Synthesizing from the overlay image needs its base VM.
+        utils.remember_overlay_origin(request, obj_id,
+                                      cloudlet_api.get_overlay_name(obj_id))
+        catalog.invalidate(catalog.IMAGES)
 
 
 class VMSynthesisLink(tables.LinkAction):
@@ -191,7 +206,7 @@ class VMHandoffLink(tables.LinkAction):
     def allowed(self, request, instance=None):
         is_active = instance.status in ACTIVE_STATES
         is_synthesized = False
-        cloudlet_type = utils.get_cloudlet_type(instance)
+        cloudlet_type = utils.get_cloudlet_type(instance, request)
         if cloudlet_type == 'cloudlet_overlay':
             is_synthesized = True
         return is_synthesized
@@ -225,10 +240,15 @@ def get_instance_error(instance):
 
 
 class UpdateRow(tables.Row):
-    ajax = True
+    # Pending rows are refreshed together by BatchRowUpdateView instead of
+    # one request per row, see _batch_row_update.html.
+    ajax = False
 
     def get_data(self, request, instance_id):
         instance = api.nova.server_get(request, instance_id)
+        instance_type = utils.get_cloudlet_type(instance, request)
+        if instance_type in CLOUDLET_TYPE_DISPLAY:
+            instance.cloudlet_type = CLOUDLET_TYPE_DISPLAY[instance_type]
         try:
             instance.full_flavor = api.nova.flavor_get(request,
                                                        instance.flavor["id"])
@@ -249,6 +269,104 @@ class UpdateRow(tables.Row):
             messages.error(request, error)
         return instance
 
+    def get_batch_data(self, request, instance_ids, changes_since=None):
+        """Return the given instances keyed by ID, None when deleted.
+
+        With ``changes_since`` Nova only lists the instances changed since
+        then, deleted ones included, and the IDs left out of the result
+        did not change. Otherwise a few instances are fetched one by one
+        and more of them through one listing of the project, the ones which
+        could not be fetched are left out.
+        """
+        wanted = set(instance_ids)
+        if changes_since:
+            servers, _more = api.nova.server_list(
+                request, search_opts={'changes-since': changes_since})
+            data = {}
+        elif len(wanted) <= BATCH_GET_THRESHOLD:
+            servers, failed = _get_servers(request, wanted)
+            data = dict.fromkeys(wanted - failed)
+        else:
+            servers, _more = api.nova.server_list(request)
+            data = dict.fromkeys(wanted)
+        instances = []
+        for server in servers:
+            if server.id not in wanted:
+                continue
+            if server.status == 'DELETED':
+                data[server.id] = None
+            else:
+                instances.append(server)
+                data[server.id] = server
+        if not instances:
+            return data
+
+        try:
+            flavors = dict((str(flavor.id), flavor)
+                           for flavor in catalog.flavor_list(request))
+        except Exception:
+            flavors = {}
+            exceptions.handle(request, ignore=True)
+        missing = set(str(instance.flavor.get("id"))
+                      for instance in instances) - set(flavors)
+        if missing:
+            flavors.update(utils.get_flavors_by_id(request, missing))
+        for instance in instances:
+            flavor_id = str(instance.flavor.get("id"))
+            if flavor_id in flavors:
+                instance.full_flavor = flavors[flavor_id]
+
+        try:
+            api.network.servers_update_addresses(request, instances)
+        except Exception:
+            exceptions.handle(request,
+                              _('Unable to retrieve Network information '
+                                'for instances.'),
+                              ignore=True)
+
+        image_map = utils.resolve_instance_images(request, instances)
+        instance_types = utils.classify_instances(request, instances,
+                                                  image_map)
+        for instance in instances:
+            instance_type = instance_types.get(instance.id)
+            if instance_type in CLOUDLET_TYPE_DISPLAY:
+                instance.cloudlet_type = CLOUDLET_TYPE_DISPLAY[instance_type]
+            error = get_instance_error(instance)
+            if error:
+                messages.error(request, error)
+        return data
+
+
+def _fetch_server(request, instance_id):
+    # Returns (server, failed), server is None when it no longer exists.
+    try:
+        return api.nova.server_get(request, instance_id), False
+    except nova_exceptions.NotFound:
+        return None, False
+    except Exception:
+        LOG.warning("Unable to retrieve instance %s.", instance_id,
+                    exc_info=True)
+        return None, True
+
+
+def _get_servers(request, instance_ids):
+    """Fetch instances one by one, return them and the IDs which failed."""
+    instance_ids = list(instance_ids)
+    results = utils.run_parallel(
+        _fetch_server,
+        [(request, instance_id) for instance_id in instance_ids],
+        utils.get_flavor_resolver_config()['max_workers'])
+    servers = []
+    failed = set()
+    # _fetch_server handles its errors, run_parallel has none to report.
+    for instance_id, (result, _error) in zip(instance_ids, results):
+        server, fetch_failed = result
+        if fetch_failed:
+            failed.add(instance_id)
+        elif server is not None:
+            servers.append(server)
+    return servers, failed
+
 
 def cloudlet_type(instance):
     if hasattr(instance, "cloudlet_type"):
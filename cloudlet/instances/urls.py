@@ -21,4 +21,5 @@ urlpatterns = [
     url(r'^resume/$', views.ResumeInstanceView.as_view(), name='resume'),
     url(r'^synthesis/$', views.SynthesisInstanceView.as_view(), name='synthesis'),
     url(INSTANCES % 'handoff', views.HandoffInstanceView.as_view(), name='handoff'),
+    url(r'^instances/rows/$', views.BatchRowUpdateView.as_view(), name='batch_update'),
 ]
@@ -10,8 +10,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import logging
+
+from django import http
 from django.core.urlresolvers import reverse_lazy
 from django.utils.translation import ugettext_lazy as _
+from django.views import generic
 
 from horizon import forms
 from horizon import workflows
@@ -19,10 +24,17 @@ from horizon import workflows
 from openstack_dashboard import api
 from openstack_dashboard.dashboards.project.cloudlet.instances \
     import forms as project_forms
+from openstack_dashboard.dashboards.project.cloudlet.instances \
+    import tables as project_tables
 from openstack_dashboard.dashboards.project.cloudlet.workflows \
     import create_instance as project_workflows
 
 
+LOG = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
 class ResumeInstanceView(workflows.WorkflowView):
     workflow_class = project_workflows.ResumeInstance
 
@@ -60,3 +72,69 @@ class HandoffInstanceView(forms.ModalFormView):
 
     def get_initial(self):
         return {'instance_id': self.kwargs['instance_id']}
+
+
+class BatchRowUpdateView(generic.View):
+    """Render the rows of several instances in a single response.
+
+    Takes the instance IDs as repeated ``instances`` parameters and
+    returns a JSON object mapping every ID to its row HTML, or to an empty
+    string when the instance no longer exists. The response carries a
+    ``changes_since`` time for the next poll, which then only gets the
+    rows of the instances changed in between.
+
+    Instances which could not be fetched or rendered are left out, so
+    their rows keep polling, and the next poll is sent with the same
+    ``changes_since`` so no change is missed.
+    """
+    table_class = project_tables.InstancesTable
+    max_rows = 200
+    # Margin for the clock skew between the dashboard and Nova.
+    changes_since_margin = 60
+
+    def get(self, request, *args, **kwargs):
+        name = self.table_class._meta.name
+        instance_ids = [instance_id for instance_id
+                        in request.GET.getlist(name) if instance_id]
+        instance_ids = instance_ids[:self.max_rows]
+        changes_since = request.GET.get('changes_since') or None
+        if changes_since is not None:
+            try:
+                datetime.datetime.strptime(changes_since, TIME_FORMAT)
+            except ValueError:
+                changes_since = None
+        polled_at = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.changes_since_margin)
+        rows = {}
+        complete = True
+        if instance_ids:
+            table = self.table_class(request)
+            row_class = table._meta.row_class
+            try:
+                instances = row_class(table).get_batch_data(
+                    request, instance_ids, changes_since=changes_since)
+            except Exception:
+                LOG.warning("Unable to refresh the instance rows.",
+                            exc_info=True)
+                instances = {}
+                complete = False
+            if changes_since is None and \
+                    len(instances) < len(set(instance_ids)):
+                complete = False
+            for instance_id, instance in instances.items():
+                if instance is None:
+                    rows[instance_id] = ''
+                    continue
+                try:
+                    row = row_class(table)
+                    row.load_cells(instance)
+                    rows[instance_id] = row.render()
+                except Exception:
+                    LOG.warning("Unable to render the row of instance %s.",
+                                instance_id, exc_info=True)
+                    complete = False
+        if complete:
+            changes_since = polled_at.strftime(TIME_FORMAT)
+        return http.JsonResponse({
+            'rows': {name: rows},
+            'changes_since': changes_since})
@@ -0,0 +1,325 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Background jobs for long running base VM imports and syntheses.
+
+Jobs run in a bounded pool of worker threads of the dashboard process,
+their state is kept in a SQLite job table shared by all processes so any
+worker can report it. Archives handed to jobs are kept in ``work_dir``,
+the ones left behind by interrupted jobs are purged when a new job
+starts. A synthesis from a VM overlay image is a job as well, which puts
+the overlay in the overlay cache before it launches the instance.
+
+Jobs call the OpenStack APIs with the token of the request which started
+them, it cannot be renewed without the user's credentials. A job is only
+started when the token is valid for ``min_token_lifetime`` more seconds,
+and a job which finds it expired fails, asking the user to log in again.
+Uploads which started in time run to completion, so the token lifetime
+of Keystone should cover the queueing and image creation of an import.
+
+Configured with the ``CLOUDLET_IMPORT_JOBS`` setting::
+
+    CLOUDLET_IMPORT_JOBS = {
+        'db_path': '/var/lib/cloudlet-dashboard/jobs.sqlite3',
+        'work_dir': '/var/lib/cloudlet-dashboard/jobs',
+        'max_workers': 2,
+        'stale_after': 3600,
+        'show_failed_for': 600,
+        'min_token_lifetime': 600,
+    }
+"""
+
+import datetime
+import errno
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from multiprocessing import pool as mp_pool
+
+from django.conf import settings
+from django.utils import timezone
+
+
+LOG = logging.getLogger(__name__)
+
+IMPORT_BASE_VM = 'import_base_vm'
+SYNTHESIZE_OVERLAY = 'synthesize_overlay'
+
+JOB_ID_PREFIX = 'job-'
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STAGE_QUEUED = 'queued'
+STAGE_EXTRACTING = 'extracting'
+STAGE_CREATING = 'creating images'
+STAGE_UPLOADING = 'uploading'
+STAGE_CACHING = 'caching VM overlay'
+STAGE_LAUNCHING = 'launching'
+STAGE_FINISHED = 'finished'
+
+COLUMNS = ('id', 'tenant_id', 'kind', 'name', 'is_public', 'status',
+           'stage', 'message', 'image_id', 'bytes_total', 'bytes_done',
+           'throughput', 'created_at', 'updated_at', 'logical_size',
+           'allocated_size', 'bytes_sent')
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class TokenExpired(Exception):
+    pass
+
+
+def get_config():
+    config = {'db_path': os.path.join(tempfile.gettempdir(),
+                                      'cloudlet-jobs.sqlite3'),
+              'work_dir': os.path.join(tempfile.gettempdir(),
+                                       'cloudlet-jobs'),
+              'max_workers': 2,
+              'stale_after': 3600,
+              'show_failed_for': 600,
+              'min_token_lifetime': 600}
+    config.update(getattr(settings, 'CLOUDLET_IMPORT_JOBS', {}))
+    return config
+
+
+class JobStore(object):
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cloudlet_jobs ("
+                "id TEXT PRIMARY KEY, tenant_id TEXT, kind TEXT, "
+                "name TEXT, is_public INTEGER, status TEXT, stage TEXT, "
+                "message TEXT, image_id TEXT, bytes_total INTEGER, "
+                "bytes_done INTEGER, throughput REAL, "
+                "created_at REAL, updated_at REAL, logical_size INTEGER, "
+                "allocated_size INTEGER, bytes_sent INTEGER)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, tenant_id, kind, name, is_public=False):
+        job_id = JOB_ID_PREFIX + uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO cloudlet_jobs (id, tenant_id, kind, name, "
+                "is_public, status, stage, bytes_total, bytes_done, "
+                "throughput, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0, 0, ?, ?)",
+                (job_id, tenant_id, kind, name, int(bool(is_public)),
+                 RUNNING, STAGE_QUEUED, now, now))
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        names = [name for name in fields if name in COLUMNS]
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE cloudlet_jobs SET %s WHERE id = ?"
+                % ", ".join("%s = ?" % name for name in names),
+                [fields[name] for name in names] + [job_id])
+
+    def finish(self, job_id, image_id=None, **sizes):
+        """Mark a job as done, ``sizes`` are the size columns to set."""
+        self.update(job_id, status=DONE, stage=STAGE_FINISHED,
+                    image_id=image_id, **sizes)
+
+    def fail(self, job_id, message):
+        self.update(job_id, status=FAILED, message=message)
+
+    def _expire(self, job):
+        # A running job which stopped reporting belonged to a worker which
+        # went away, e.g. on an Apache restart.
+        stale_after = get_config()['stale_after']
+        if job['status'] == RUNNING and \
+                job['updated_at'] < time.time() - stale_after:
+            self.fail(job['id'], "Interrupted")
+            job['status'] = FAILED
+            job['message'] = "Interrupted"
+        return job
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM cloudlet_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        return self._expire(dict(zip(row.keys(), row)))
+
+    def list_visible(self, tenant_id, kind):
+        """Running jobs, and the ones which failed recently."""
+        failed_since = time.time() - get_config()['show_failed_for']
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM cloudlet_jobs WHERE tenant_id = ? "
+                "AND kind = ? AND (status = ? OR "
+                "(status = ? AND updated_at > ?)) ORDER BY created_at",
+                (tenant_id, kind, RUNNING, FAILED, failed_since)).fetchall()
+        jobs = [self._expire(dict(zip(row.keys(), row))) for row in rows]
+        return jobs
+
+
+def purge_work_dir(store):
+    """Remove the archives of the jobs which are no longer running."""
+    work_dir = get_config()['work_dir']
+    try:
+        names = os.listdir(work_dir)
+    except OSError:
+        return
+    for name in names:
+        job_id, ext = os.path.splitext(name)
+        if not is_job_id(job_id) or ext != '.zip':
+            continue
+        job = store.get(job_id)
+        if job is None or job['status'] != RUNNING:
+            try:
+                os.remove(os.path.join(work_dir, name))
+            except OSError:
+                LOG.warning("Unable to remove %s", name)
+
+
+def token_lifetime(request):
+    """Seconds left before the token of ``request`` expires, or None."""
+    expires = getattr(getattr(request.user, 'token', None), 'expires', None)
+    if expires is None:
+        return None
+    if timezone.is_naive(expires):
+        expires = timezone.make_aware(expires, timezone.utc)
+    now = datetime.datetime.utcnow().replace(tzinfo=timezone.utc)
+    return (expires - now).total_seconds()
+
+
+def check_token(request, min_lifetime=0):
+    """Raise TokenExpired unless the token lives ``min_lifetime`` more."""
+    lifetime = token_lifetime(request)
+    if lifetime is not None and lifetime < min_lifetime:
+        raise TokenExpired("The token expires in %ds" % lifetime)
+
+
+def is_job_id(value):
+    return value.startswith(JOB_ID_PREFIX)
+
+
+def get_store():
+    return JobStore(get_config()['db_path'])
+
+
+class Job(object):
+    """Table datum standing in for the image an import job will create."""
+    is_import_job = True
+    protected = True
+
+    def __init__(self, job):
+        self.job = job
+        self.id = job['id']
+        self.owner = job['tenant_id']
+        self.is_public = bool(job['is_public'])
+        self.properties = {}
+        if job['status'] == RUNNING:
+            self.status = 'saving'
+            progress = job['stage']
+            if job['stage'] in (STAGE_UPLOADING, STAGE_CACHING) and \
+                    job['bytes_total']:
+                progress = "%s %d%%, %.1f MB/s" % (
+                    job['stage'],
+                    100 * job['bytes_done'] / job['bytes_total'],
+                    job['throughput'] or 0)
+        else:
+            self.status = 'killed'
+            progress = job['message'] or job['status']
+        self.name = "%s (%s)" % (job['name'], progress)
+
+
+class ProgressReporter(object):
+    """Callable adding uploaded bytes to a job, flushed once a second."""
+    def __init__(self, store, job_id, interval=1.0):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self.bytes_done = 0
+        self._started = time.time()
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self.bytes_done += nbytes
+            if time.time() - self._flushed >= self.interval:
+                self._flush()
+
+    def _flush(self):
+        now = time.time()
+        elapsed = max(now - self._started, 0.001)
+        self.store.update(self.job_id,
+                          bytes_done=self.bytes_done,
+                          throughput=self.bytes_done / elapsed / 1024 / 1024)
+        self._flushed = now
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+
+def keep_upload(uploaded_file, job_id):
+    """Keep an uploaded file beyond the request, return its new path.
+
+    ``uploaded_file`` is a Django upload, which is deleted when the request
+    ends, or the path of a chunked upload. Files on disk are hard linked
+    into the job directory, other uploads are copied.
+    """
+    work_dir = get_config()['work_dir']
+    try:
+        os.makedirs(work_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    purge_work_dir(get_store())
+    path = os.path.join(work_dir, "%s.zip" % job_id)
+    if isinstance(uploaded_file, basestring):
+        source = uploaded_file
+    elif hasattr(uploaded_file, 'temporary_file_path'):
+        source = uploaded_file.temporary_file_path()
+    else:
+        source = None
+    if source is not None:
+        try:
+            os.link(source, path)
+            return path
+        except OSError:
+            LOG.debug("Unable to link the upload, copying it.",
+                      exc_info=True)
+        shutil.copyfile(source, path)
+        return path
+    uploaded_file.seek(0)
+    with open(path, 'wb') as out:
+        shutil.copyfileobj(uploaded_file, out)
+    return path
+
+
+def submit(func, *args):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = mp_pool.ThreadPool(processes=get_config()['max_workers'])
+    return _POOL.apply_async(func, args)
@@ -0,0 +1,436 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Size-bounded LRU cache of VM overlay data on the dashboard host.
+
+Overlays are kept as files named after the Glance image ID and checksum,
+so a changed image never hits a stale entry. A file is only added once
+its MD5 matched the Glance checksum. Every hit refreshes the modification
+time, eviction removes the least recently used files first. Hit, miss
+and eviction counts are kept in a stats file next to the overlays, they
+are logged with the cache size at debug level whenever an overlay is
+added.
+
+Cached overlays can be handed to the web server for delivery, with
+``X-Sendfile`` (Apache mod_xsendfile) or ``X-Accel-Redirect`` (nginx,
+the file name is appended to ``sendfile_prefix``). Otherwise they are
+served through the WSGI file wrapper.
+
+The cache is off unless it is enabled with a ``cache_dir`` of its own.
+
+Compute nodes have no token to read Glance with. When the web server
+publishes the cache directory to them under ``public_url``, overlays
+synthesized from a Glance image are put in the cache and handed to Nova
+by a URL which expires after ``public_url_ttl`` seconds. The URL is
+signed with ``public_url_secret`` the way the nginx secure_link module
+checks it, so the web server only serves the overlays handed out::
+
+    location /cloudlet-overlays/ {
+        secure_link $arg_md5,$arg_expires;
+        secure_link_md5 "$secure_link_expires$uri <public_url_secret>";
+        if ($secure_link = "") { return 403; }
+        if ($secure_link = "0") { return 410; }
+        alias /var/cache/cloudlet-dashboard/overlays/;
+    }
+
+Entries handed out are pinned, eviction skips them until they are
+unpinned or the pin expired.
+
+Configured with the ``CLOUDLET_OVERLAY_CACHE`` setting::
+
+    CLOUDLET_OVERLAY_CACHE = {
+        'enabled': True,
+        'cache_dir': '/var/cache/cloudlet-dashboard/overlays',
+        'max_size': 20 * 1024 ** 3,
+        'sendfile_header': 'X-Accel-Redirect',
+        'sendfile_prefix': '/cloudlet-overlays-internal/',
+        'public_url': 'http://controller/cloudlet-overlays/',
+        'public_url_secret': 'change me',
+        'public_url_ttl': 3600,
+    }
+"""
+
+import base64
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import urlparse
+import uuid
+
+from django import http
+from django.conf import settings
+
+
+LOG = logging.getLogger(__name__)
+
+FILL_PREFIX = '.fill-'
+PIN_PREFIX = '.pin-'
+LOCK_FILENAME = '.lock'
+STATS_FILENAME = '.stats.json'
+
+STAT_NAMES = ('hits', 'misses', 'fills', 'rejected', 'evictions',
+              'evicted_bytes')
+
+# Fills left behind by a dead worker are removed after a day.
+STALE_FILL_AGE = 86400
+
+_KEY_PART = re.compile(r'^[A-Za-z0-9-]+$')
+_PIN = re.compile(r'^[A-Za-z0-9-]+\.[0-9a-f]+$')
+
+
+def get_config():
+    config = {'enabled': False,
+              'cache_dir': None,
+              'max_size': 2 * 1024 ** 3,
+              'sendfile_header': None,
+              'sendfile_prefix': '',
+              'public_url': None,
+              'public_url_secret': None,
+              'public_url_ttl': 3600,
+              'chunk_size': 1024 * 1024}
+    config.update(getattr(settings, 'CLOUDLET_OVERLAY_CACHE', {}))
+    return config
+
+
+class OverlayCache(object):
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, image_id, checksum):
+        if not (_KEY_PART.match(image_id) and _KEY_PART.match(checksum)):
+            return None
+        return os.path.join(self.cache_dir, '%s-%s' % (image_id, checksum))
+
+    def _locked(self):
+        return _FileLock(os.path.join(self.cache_dir, LOCK_FILENAME))
+
+    def _count(self, **counts):
+        with self._locked():
+            self._add_stats(counts)
+
+    def _add_stats(self, counts):
+        # Called with the lock held.
+        stats = self._read_stats()
+        for name, count in counts.items():
+            stats[name] = stats.get(name, 0) + count
+        path = os.path.join(self.cache_dir, STATS_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.rename(path + '.tmp', path)
+
+    def _read_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILENAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def stats(self):
+        """Return the counters and the current number and size of entries."""
+        stats = dict((name, 0) for name in STAT_NAMES)
+        stats.update(self._read_stats())
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(size for _mtime, size, _path in entries)
+        stats['max_size'] = self.max_size
+        return stats
+
+    def lookup(self, image_id, checksum, size):
+        """Return an open file with the cached overlay, or None.
+
+        The file is opened before anything can evict it. An entry whose
+        size does not match the image is dropped.
+        """
+        path = self._path(image_id, checksum)
+        if path is None:
+            return None
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self._count(misses=1)
+            return None
+        if os.fstat(f.fileno()).st_size != size:
+            f.close()
+            self._remove(path)
+            self._count(misses=1)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count(hits=1)
+        return f
+
+    def fill(self, image_id, checksum, size, chunks):
+        """Pass ``chunks`` through, keeping a copy of them in the cache.
+
+        The copy is added once all ``size`` bytes went through and their
+        MD5 matches ``checksum``. A download which is cut short, or a
+        failing write to the cache, leaves the cache untouched.
+        """
+        path = self._path(image_id, checksum)
+        if path is None or size > self.max_size:
+            for chunk in chunks:
+                yield chunk
+            return
+        fd, fill_path = tempfile.mkstemp(prefix=FILL_PREFIX,
+                                         dir=self.cache_dir)
+        f = os.fdopen(fd, 'wb')
+        md5 = hashlib.md5()
+        written = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    try:
+                        f.write(chunk)
+                    except IOError:
+                        LOG.warning("Unable to cache overlay %s",
+                                    image_id, exc_info=True)
+                        f.close()
+                        f = None
+                    md5.update(chunk)
+                    written += len(chunk)
+                yield chunk
+            complete = f is not None
+        finally:
+            if f is not None:
+                f.close()
+            if complete and written == size and \
+                    md5.hexdigest() == checksum.lower():
+                self._commit(fill_path, path, size)
+            else:
+                if complete:
+                    LOG.warning("Overlay %s does not match its checksum, "
+                                "not caching it", image_id)
+                    self._count(rejected=1)
+                self._remove(fill_path)
+
+    def pin(self, image_id, checksum, until):
+        """Keep an entry from being evicted until the time ``until``.
+
+        The entry need not exist yet, so it can be pinned before it is
+        filled. Returns the pin to hand to ``unpin``, or None.
+        """
+        path = self._path(image_id, checksum)
+        if path is None:
+            return None
+        pin = '%s.%s' % (os.path.basename(path), uuid.uuid4().hex)
+        pin_path = os.path.join(self.cache_dir, PIN_PREFIX + pin)
+        with self._locked():
+            open(pin_path, 'w').close()
+            os.utime(pin_path, (until, until))
+        return pin
+
+    def unpin(self, pin):
+        if _PIN.match(pin):
+            self._remove(os.path.join(self.cache_dir, PIN_PREFIX + pin))
+
+    def _pinned(self, now):
+        # Called with the lock held, returns the paths of the pinned
+        # entries and drops the expired pins, whose mtime is their end.
+        pinned = set()
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith(PIN_PREFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                until = os.path.getmtime(path)
+            except OSError:
+                continue
+            if until < now:
+                self._remove(path)
+            else:
+                key = name[len(PIN_PREFIX):].rsplit('.', 1)[0]
+                pinned.add(os.path.join(self.cache_dir, key))
+        return pinned
+
+    def _commit(self, fill_path, path, size):
+        with self._locked():
+            evicted = self._evict(size)
+            if evicted is not None:
+                os.rename(fill_path, path)
+                self._add_stats({'fills': 1,
+                                 'evictions': evicted[0],
+                                 'evicted_bytes': evicted[1]})
+        if evicted is None:
+            LOG.warning("Pinned overlays leave no room to cache %s",
+                        os.path.basename(path))
+            self._count(rejected=1)
+            self._remove(fill_path)
+            return
+        evicted, evicted_bytes = evicted
+        if evicted:
+            LOG.info("Evicted %d overlays (%d bytes) from the cache",
+                     evicted, evicted_bytes)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Overlay cache stats: %s", self.stats())
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self, reserve):
+        # Called with the lock held, makes room for ``reserve`` bytes.
+        # Returns the number and size of the evicted entries, or None
+        # when the pinned entries leave no room.
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(FILL_PREFIX):
+                try:
+                    if os.path.getmtime(path) < now - STALE_FILL_AGE:
+                        self._remove(path)
+                except OSError:
+                    pass
+        pinned = self._pinned(now)
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _path in entries)
+        pinned_size = sum(size for _mtime, size, path in entries
+                          if path in pinned)
+        if pinned_size + reserve > self.max_size:
+            return None
+        entries = [entry for entry in entries if entry[2] not in pinned]
+        evicted = evicted_bytes = 0
+        while entries and total + reserve > self.max_size:
+            _mtime, size, path = entries.pop(0)
+            self._remove(path)
+            total -= size
+            evicted += 1
+            evicted_bytes += size
+        return evicted, evicted_bytes
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _FileLock(object):
+    """Exclusive lock shared by all the processes using the cache."""
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def get_cache():
+    """Return the overlay cache, or None when it is disabled or unusable."""
+    config = get_config()
+    if not (config['enabled'] and config['cache_dir']):
+        return None
+    try:
+        return OverlayCache(config['cache_dir'], config['max_size'])
+    except OSError:
+        LOG.warning("Unable to use the overlay cache in %s",
+                    config['cache_dir'], exc_info=True)
+        return None
+
+
+def is_published():
+    """Whether the cached overlays are published to the compute nodes."""
+    config = get_config()
+    return bool(config['enabled'] and config['cache_dir'] and
+                config['public_url'] and config['public_url_secret'])
+
+
+def get_public_url(image_id, checksum, expires):
+    """Return the URL compute nodes fetch a cached overlay from, or None.
+
+    The URL is signed for the web server to serve it until the time
+    ``expires``, see the module docstring.
+    """
+    if not (is_published() and _KEY_PART.match(image_id) and
+            _KEY_PART.match(checksum)):
+        return None
+    config = get_config()
+    url = '%s/%s-%s' % (config['public_url'].rstrip('/'), image_id, checksum)
+    expires = int(expires)
+    digest = hashlib.md5('%d%s %s' % (expires, urlparse.urlparse(url).path,
+                                      config['public_url_secret'])).digest()
+    signature = base64.urlsafe_b64encode(digest).rstrip('=')
+    return '%s?md5=%s&expires=%d' % (url, signature, expires)
+
+
+def _iter_file(f, start, length, chunk_size):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def file_response(f, byte_range, size):
+    """Build the response serving a cached overlay from the open file ``f``.
+
+    With a sendfile header the web server reads the file and handles
+    ranges itself, the response only carries the header.
+    """
+    config = get_config()
+    header = config['sendfile_header']
+    if header:
+        f.close()
+        response = http.HttpResponse(content_type="application/octet-stream")
+        if header == 'X-Accel-Redirect':
+            response[header] = '%s/%s' % (
+                config['sendfile_prefix'].rstrip('/'),
+                os.path.basename(f.name))
+        else:
+            response[header] = f.name
+        return response
+    if byte_range is None:
+        response = http.FileResponse(f, content_type="application/octet-stream")
+        response['Content-Length'] = size
+        return response
+    start, end = byte_range
+    response = http.StreamingHttpResponse(
+        _iter_file(f, start, end - start + 1, config['chunk_size']),
+        status=206, content_type="application/octet-stream")
+    response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Content-Length'] = end - start + 1
+    return response
@@ -10,10 +10,447 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import zipfile
+
+from horizon import exceptions
+from horizon import messages
+from horizon import tables
 from horizon.test import helpers as test
 
+from openstack_dashboard.dashboards.project.cloudlet import jobs
+from openstack_dashboard.dashboards.project.cloudlet import overlay_cache
+from openstack_dashboard.dashboards.project.cloudlet import uploads
+from openstack_dashboard.dashboards.project.cloudlet import utils
+from openstack_dashboard.dashboards.project.cloudlet import views
+
 
 class CloudletTests(test.TestCase):
     # Unit tests for cloudlet.
     def test_me(self):
         self.assertTrue(1 + 1 == 2)
+
+
+class ByteRangeTests(test.TestCase):
+    def test_parse_byte_range(self):
+        self.assertEqual((0, 99), utils.parse_byte_range('bytes=0-', 100))
+        self.assertEqual((10, 19), utils.parse_byte_range('bytes=10-19', 100))
+        self.assertEqual((50, 99),
+                         utils.parse_byte_range('bytes=50-600', 100))
+        self.assertEqual((95, 99), utils.parse_byte_range('bytes=-5', 100))
+        self.assertEqual((0, 99), utils.parse_byte_range('bytes=-500', 100))
+
+    def test_parse_byte_range_ignored(self):
+        self.assertIsNone(utils.parse_byte_range('items=0-1', 100))
+        self.assertIsNone(utils.parse_byte_range('bytes=0-1,5-6', 100))
+        self.assertIsNone(utils.parse_byte_range('bytes=a-b', 100))
+        self.assertIsNone(utils.parse_byte_range('bytes=5-3', 100))
+
+    def test_parse_byte_range_not_satisfiable(self):
+        self.assertRaises(ValueError,
+                          utils.parse_byte_range, 'bytes=100-200', 100)
+        self.assertRaises(ValueError,
+                          utils.parse_byte_range, 'bytes=-0', 100)
+
+    def test_rechunk(self):
+        body = ['ab', 'cdefg', '', 'hij']
+        self.assertEqual(['abcd', 'efgh', 'ij'],
+                         list(utils._rechunk(iter(body), 4)))
+
+    def test_rechunk_skip_and_length(self):
+        body = ['ab', 'cdefg', 'hij']
+        self.assertEqual(['def', 'g'],
+                         list(utils._rechunk(iter(body), 3, skip=3,
+                                             length=4)))
+
+
+class FakeRaw(object):
+    def __init__(self, data):
+        self._stream = StringIO.StringIO(data)
+
+    def read(self, size, decode_content=False):
+        return self._stream.read(size)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = FakeRaw(data)
+
+    def close(self):
+        pass
+
+
+class FakeRangeSession(object):
+    """Serves ``data`` the way a web server answers Range requests."""
+    def __init__(self, data, ranges=True):
+        self.data = data
+        self.ranges = ranges
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        byte_range = headers['Range']
+        self.requests.append(byte_range)
+        size = len(self.data)
+        if not self.ranges:
+            return FakeResponse(200, {}, self.data)
+        start, end = utils.parse_byte_range(byte_range, size)
+        return FakeResponse(
+            206, {'Content-Range': 'bytes %d-%d/%d' % (start, end, size)},
+            self.data[start:end + 1])
+
+
+class RemoteFileTests(test.TestCase):
+    def _archive(self):
+        buf = StringIO.StringIO()
+        archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED)
+        archive.writestr('overlay-memory', os.urandom(512 * 1024))
+        archive.writestr(utils.OVERLAY_META_NAME, 'meta data')
+        archive.close()
+        return buf.getvalue()
+
+    def test_read_member(self):
+        data = self._archive()
+        session = FakeRangeSession(data)
+        remote = utils.RemoteFile('http://overlay', session=session,
+                                  block_size=4096, byte_budget=64 * 1024)
+        archive = zipfile.ZipFile(remote)
+        self.assertEqual('meta data', archive.read(utils.OVERLAY_META_NAME))
+        self.assertEqual(len(data), remote.size)
+        self.assertTrue(remote.bytes_fetched < 16 * 1024)
+
+    def test_byte_budget(self):
+        session = FakeRangeSession(self._archive())
+        remote = utils.RemoteFile('http://overlay', session=session,
+                                  block_size=4096, byte_budget=8192)
+        remote.seek(0)
+        self.assertRaises(utils.ByteBudgetExceeded,
+                          remote.read, 64 * 1024)
+
+    def test_range_not_supported(self):
+        session = FakeRangeSession(self._archive(), ranges=False)
+        self.assertRaises(utils.RangeNotSupported, utils.RemoteFile,
+                          'http://overlay', session=session)
+
+
+class SparseFileTests(test.TestCase):
+    def setUp(self):
+        super(SparseFileTests, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.seek(1024 * 1024)
+            f.write('x' * 4096)
+            f.truncate(4 * 1024 * 1024)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(SparseFileTests, self).tearDown()
+
+    def test_data_extents(self):
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            extents = list(utils.data_extents(f.fileno(), size))
+        # File systems without hole support report a single extent.
+        self.assertTrue(extents)
+        for start, end in extents:
+            self.assertTrue(0 <= start < end <= size)
+        self.assertTrue(any(start <= 1024 * 1024 and
+                            1024 * 1024 + 4096 <= end
+                            for start, end in extents))
+
+    def test_sparse_file_stream(self):
+        stream = utils.SparseFileStream(self.path)
+        self.assertEqual(4 * 1024 * 1024, stream.size)
+        self.assertTrue(4096 <= stream.allocated_size <= stream.size)
+        data = ''.join(iter(lambda: stream.read(300 * 1024), ''))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class BaseVMsTests(test.TestCase):
+    def test_size_to_gb_rounds_up(self):
+        gb = 1024 ** 3
+        self.assertEqual(1, utils.BaseVMs.size_to_gb(1))
+        self.assertEqual(10, utils.BaseVMs.size_to_gb(10 * gb))
+        self.assertEqual(11, utils.BaseVMs.size_to_gb(10 * gb + gb / 2))
+
+
+class ChunkedUploadTests(test.TestCase):
+    def setUp(self):
+        super(ChunkedUploadTests, self).setUp()
+        self.upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.upload_dir, True)
+        override = self.settings(CLOUDLET_CHUNKED_UPLOAD={
+            'upload_dir': self.upload_dir, 'chunk_size': 8})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.upload = uploads.create('tenant', 'base.zip', 12)
+
+    def _write(self, offset, data, checksum=None):
+        return uploads.write_chunk('tenant', self.upload['id'], offset,
+                                   len(data), StringIO.StringIO(data),
+                                   checksum)
+
+    def test_write_chunks(self):
+        self._write(0, 'abcdefgh')
+        status = self._write(8, 'ijkl', hashlib.sha256('ijkl').hexdigest())
+        self.assertTrue(status['complete'])
+        with open(uploads.get_path('tenant', self.upload['id'])) as f:
+            self.assertEqual('abcdefghijkl', f.read())
+
+    def test_offset_conflict(self):
+        self._write(0, 'abcdefgh')
+        try:
+            self._write(0, 'abcdefgh')
+        except uploads.UploadError as e:
+            self.assertEqual(409, e.status)
+            self.assertEqual(8, e.offset)
+        else:
+            self.fail("A chunk at the wrong offset was accepted")
+
+    def test_checksum_mismatch(self):
+        try:
+            self._write(0, 'abcdefgh', hashlib.sha256('other').hexdigest())
+        except uploads.UploadError as e:
+            self.assertEqual(400, e.status)
+            self.assertEqual(0, e.offset)
+        else:
+            self.fail("A chunk with a wrong checksum was accepted")
+        status = uploads.status('tenant', self.upload['id'])
+        self.assertEqual(0, status['offset'])
+
+    def test_other_tenant(self):
+        self.assertRaises(uploads.UploadError, uploads.status,
+                          'other', self.upload['id'])
+
+
+class OverlayCacheTests(test.TestCase):
+    def setUp(self):
+        super(OverlayCacheTests, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        self.cache = overlay_cache.OverlayCache(self.cache_dir, 100)
+
+    def _fill(self, image_id, data, checksum=None):
+        checksum = checksum or hashlib.md5(data).hexdigest()
+        chunks = [data[i:i + 16] for i in range(0, len(data), 16)]
+        sent = ''.join(self.cache.fill(image_id, checksum, len(data),
+                                       iter(chunks)))
+        self.assertEqual(data, sent)
+        return checksum
+
+    def test_fill_and_lookup(self):
+        data = 'a' * 40
+        checksum = self._fill('image-1', data)
+        cached = self.cache.lookup('image-1', checksum, len(data))
+        self.assertEqual(data, cached.read())
+        cached.close()
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['fills'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(40, stats['size'])
+
+    def test_disabled_without_cache_dir(self):
+        with self.settings(CLOUDLET_OVERLAY_CACHE={}):
+            self.assertIsNone(overlay_cache.get_cache())
+        with self.settings(CLOUDLET_OVERLAY_CACHE={'enabled': True}):
+            self.assertIsNone(overlay_cache.get_cache())
+        with self.settings(CLOUDLET_OVERLAY_CACHE={
+                'enabled': True, 'cache_dir': self.cache_dir}):
+            self.assertEqual(self.cache_dir,
+                             overlay_cache.get_cache().cache_dir)
+
+    def test_checksum_mismatch_not_cached(self):
+        self._fill('image-1', 'a' * 40, checksum='0' * 32)
+        self.assertIsNone(self.cache.lookup('image-1', '0' * 32, 40))
+        self.assertEqual(1, self.cache.stats()['rejected'])
+
+    def test_least_recently_used_evicted(self):
+        first = self._fill('image-1', 'a' * 40)
+        second = self._fill('image-2', 'b' * 40)
+        # Make the first overlay the most recently used one.
+        old = time.time() - 60
+        os.utime(os.path.join(self.cache_dir, 'image-2-%s' % second),
+                 (old, old))
+        self.cache.lookup('image-1', first, 40).close()
+        self._fill('image-3', 'c' * 40)
+        self.assertIsNone(self.cache.lookup('image-2', second, 40))
+        self.assertIsNotNone(self.cache.lookup('image-1', first, 40))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(80, stats['size'])
+
+    def test_pinned_entry_not_evicted(self):
+        first = self.cache.pin('image-1', hashlib.md5('a' * 40).hexdigest(),
+                               time.time() + 60)
+        self._fill('image-1', 'a' * 40)
+        second = self._fill('image-2', 'b' * 40)
+        old = time.time() - 60
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('image-'):
+                os.utime(os.path.join(self.cache_dir, name), (old, old))
+        self._fill('image-3', 'c' * 40)
+        self.assertIsNone(self.cache.lookup('image-2', second, 40))
+        # No room is left by the pinned entry and the new one.
+        checksum = self._fill('image-4', 'd' * 80)
+        self.assertIsNone(self.cache.lookup('image-4', checksum, 80))
+        self.cache.unpin(first)
+        checksum = self._fill('image-4', 'd' * 80)
+        self.assertIsNotNone(self.cache.lookup('image-4', checksum, 80))
+
+    def test_expired_pin_dropped(self):
+        checksum = hashlib.md5('a' * 40).hexdigest()
+        self.cache.pin('image-1', checksum, time.time() - 1)
+        self._fill('image-1', 'a' * 40)
+        self._fill('image-2', 'b' * 80)
+        self.assertIsNone(self.cache.lookup('image-1', checksum, 40))
+        self.assertFalse([name for name in os.listdir(self.cache_dir)
+                          if name.startswith(overlay_cache.PIN_PREFIX)])
+
+    def test_public_url_signed(self):
+        with self.settings(CLOUDLET_OVERLAY_CACHE={
+                'enabled': True, 'cache_dir': self.cache_dir,
+                'public_url': 'http://controller/overlays/'}):
+            self.assertIsNone(
+                overlay_cache.get_public_url('image-1', 'abc', 1000))
+        with self.settings(CLOUDLET_OVERLAY_CACHE={
+                'enabled': True, 'cache_dir': self.cache_dir,
+                'public_url': 'http://controller/overlays/',
+                'public_url_secret': 'secret'}):
+            url = overlay_cache.get_public_url('image-1', 'abc', 1000)
+        # The signature of nginx secure_link_md5
+        # "$secure_link_expires$uri secret".
+        self.assertEqual('http://controller/overlays/image-1-abc'
+                         '?md5=Wvv8msjN3M-YShqL25LbvA&expires=1000', url)
+
+
+class JobStoreTests(test.TestCase):
+    def setUp(self):
+        super(JobStoreTests, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        override = self.settings(CLOUDLET_IMPORT_JOBS={
+            'db_path': os.path.join(self.work_dir, 'jobs.sqlite3'),
+            'work_dir': self.work_dir,
+            'stale_after': 60})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.store = jobs.get_store()
+
+    def test_stale_job_expires(self):
+        job_id = self.store.create('tenant', jobs.IMPORT_BASE_VM, 'base')
+        self.store.update(job_id, stage=jobs.STAGE_UPLOADING)
+        self.assertEqual(jobs.RUNNING, self.store.get(job_id)['status'])
+        with self.store._connect() as conn:
+            conn.execute("UPDATE cloudlet_jobs SET updated_at = ?",
+                         (time.time() - 120,))
+        job = self.store.get(job_id)
+        self.assertEqual(jobs.FAILED, job['status'])
+        self.assertEqual("Interrupted", job['message'])
+        self.assertEqual(jobs.FAILED, self.store.get(job_id)['status'])
+
+    def test_finished_job_does_not_expire(self):
+        job_id = self.store.create('tenant', jobs.IMPORT_BASE_VM, 'base')
+        self.store.finish(job_id, 'image', logical_size=10,
+                          allocated_size=4, bytes_sent=4)
+        with self.store._connect() as conn:
+            conn.execute("UPDATE cloudlet_jobs SET updated_at = ?",
+                         (time.time() - 120,))
+        job = self.store.get(job_id)
+        self.assertEqual(jobs.DONE, job['status'])
+        self.assertEqual(4, job['bytes_sent'])
+
+    def test_purge_work_dir(self):
+        running = self.store.create('tenant', jobs.IMPORT_BASE_VM, 'a')
+        done = self.store.create('tenant', jobs.IMPORT_BASE_VM, 'b')
+        self.store.finish(done, 'image')
+        for job_id in (running, done, jobs.JOB_ID_PREFIX + 'unknown'):
+            open(os.path.join(self.work_dir, job_id + '.zip'), 'w').close()
+        jobs.purge_work_dir(self.store)
+        self.assertEqual(sorted([running + '.zip', 'jobs.sqlite3']),
+                         sorted(os.listdir(self.work_dir)))
+
+
+class FastTable(tables.DataTable):
+    name = tables.Column('name')
+
+    class Meta(object):
+        name = 'fast'
+
+
+class SlowTable(tables.DataTable):
+    name = tables.Column('name')
+
+    class Meta(object):
+        name = 'slow'
+        verbose_name = 'Slow rows'
+
+
+class LoaderView(views.ConcurrentMultiTableView):
+    table_classes = (FastTable, SlowTable)
+
+    def __init__(self, *args, **kwargs):
+        super(LoaderView, self).__init__(*args, **kwargs)
+        self.release = threading.Event()
+        self.slow_done = threading.Event()
+        self.slow_error = None
+
+    def get_fast_data(self):
+        messages.info(self.request, 'fast loaded')
+        self.set_pagination('fast', True)
+        return ['row']
+
+    def get_slow_data(self):
+        self.release.wait(5)
+        try:
+            if self.slow_error is not None:
+                raise self.slow_error
+            self.request.slow_loaded = True
+            messages.info(self.request, 'slow loaded')
+            self.set_pagination('slow', True)
+            return ['late row']
+        finally:
+            self.slow_done.set()
+
+
+class ConcurrentMultiTableViewTests(test.TestCase):
+    def _view(self):
+        view = LoaderView()
+        view.request = self.factory.get('/')
+        view.args = ()
+        view.kwargs = {}
+        return view
+
+    def _messages(self, view):
+        return [unicode(message) for message in view.request._messages]
+
+    def test_timed_out_loader_leaves_no_trace(self):
+        view = self._view()
+        with self.settings(CLOUDLET_CONCURRENT_TABLES={
+                'table_timeouts': {'slow': 0.1}}):
+            data = view._get_data_dict()
+        view.release.set()
+        self.assertTrue(view.slow_done.wait(5))
+
+        self.assertEqual(['row'], data['fast'])
+        self.assertEqual([], data['slow'])
+        self.assertTrue(view._more['fast'])
+        self.assertFalse(view._more['slow'])
+        received = self._messages(view)
+        self.assertIn('fast loaded', received)
+        self.assertIn('Timed out while retrieving Slow rows.', received)
+        self.assertNotIn('slow loaded', received)
+        self.assertFalse(hasattr(view.request, 'slow_loaded'))
+
+    def test_auth_error_raised_in_request_thread(self):
+        view = self._view()
+        view.slow_error = exceptions.NotAuthenticated()
+        view.release.set()
+        self.assertRaises(exceptions.NotAuthenticated, view._get_data_dict)
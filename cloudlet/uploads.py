@@ -0,0 +1,207 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Chunked, resumable uploads of base VM archives.
+
+The browser creates an upload with the archive name and size, then PUTs
+the archive in chunks at increasing offsets. A chunk may carry its
+SHA-256 in the ``X-Chunk-SHA256`` header, it is checked before the chunk
+is kept. An interrupted upload resumes from the offset reported by its
+status. Chunks are written straight from the request body to the upload
+file, Django's upload handlers are not involved.
+
+Configured with the ``CLOUDLET_CHUNKED_UPLOAD`` setting::
+
+    CLOUDLET_CHUNKED_UPLOAD = {
+        'upload_dir': '/var/lib/cloudlet-dashboard/uploads',
+        'chunk_size': 8 * 1024 * 1024,
+        'max_size': 64 * 1024 ** 3,
+        'expire_after': 86400,
+    }
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+
+LOG = logging.getLogger(__name__)
+
+DATA_FILENAME = 'data'
+META_FILENAME = 'meta.json'
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """Invalid upload request, ``status`` is the HTTP status to answer.
+
+    ``offset`` is set when a chunk did not start where the upload stands.
+    """
+    def __init__(self, message, status=400, offset=None):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def get_config():
+    config = {'upload_dir': os.path.join(tempfile.gettempdir(),
+                                         'cloudlet-uploads'),
+              'chunk_size': 8 * 1024 * 1024,
+              'max_size': 64 * 1024 ** 3,
+              'expire_after': 86400}
+    config.update(getattr(settings, 'CLOUDLET_CHUNKED_UPLOAD', {}))
+    return config
+
+
+def _upload_path(upload_id):
+    if not _UPLOAD_ID.match(upload_id or ''):
+        raise UploadError("Unknown upload", status=404)
+    return os.path.join(get_config()['upload_dir'], upload_id)
+
+
+def _load(tenant_id, upload_id):
+    path = _upload_path(upload_id)
+    try:
+        with open(os.path.join(path, META_FILENAME)) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        raise UploadError("Unknown upload", status=404)
+    if meta['tenant_id'] != tenant_id:
+        raise UploadError("Unknown upload", status=404)
+    return path, meta
+
+
+def _status(upload_id, path, meta):
+    offset = os.path.getsize(os.path.join(path, DATA_FILENAME))
+    return {'id': upload_id,
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'offset': offset,
+            'complete': offset == meta['size'],
+            'chunk_size': get_config()['chunk_size']}
+
+
+def purge_expired():
+    """Remove the uploads which did not receive a chunk for too long."""
+    config = get_config()
+    expired = time.time() - config['expire_after']
+    try:
+        names = os.listdir(config['upload_dir'])
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(config['upload_dir'], name)
+        try:
+            if os.path.getmtime(os.path.join(path, DATA_FILENAME)) < expired:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def create(tenant_id, filename, size):
+    config = get_config()
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("Invalid size")
+    if size <= 0 or size > config['max_size']:
+        raise UploadError("Size must be between 1 and %d bytes"
+                          % config['max_size'])
+    purge_expired()
+    upload_id = uuid.uuid4().hex
+    path = _upload_path(upload_id)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    meta = {'tenant_id': tenant_id,
+            'filename': os.path.basename(filename or ''),
+            'size': size,
+            'created_at': time.time()}
+    open(os.path.join(path, DATA_FILENAME), 'wb').close()
+    with open(os.path.join(path, META_FILENAME), 'w') as f:
+        json.dump(meta, f)
+    return _status(upload_id, path, meta)
+
+
+def status(tenant_id, upload_id):
+    path, meta = _load(tenant_id, upload_id)
+    return _status(upload_id, path, meta)
+
+
+def write_chunk(tenant_id, upload_id, offset, length, stream, checksum=None):
+    """Append ``length`` bytes read from ``stream`` at ``offset``.
+
+    A chunk which is short or does not match ``checksum`` is dropped, the
+    upload stays at ``offset`` and the chunk can be sent again.
+    """
+    path, meta = _load(tenant_id, upload_id)
+    if length <= 0 or length > get_config()['chunk_size']:
+        raise UploadError("Chunks must be between 1 and %d bytes"
+                          % get_config()['chunk_size'])
+    with open(os.path.join(path, DATA_FILENAME), 'r+b') as f:
+        # Retries of a chunk may race with the request they retry.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadError("Upload is at offset %d" % current,
+                                  status=409, offset=current)
+            if offset + length > meta['size']:
+                raise UploadError("Chunk goes past the end of the upload")
+            sha256 = hashlib.sha256()
+            f.seek(offset)
+            remaining = length
+            while remaining:
+                block = stream.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                sha256.update(block)
+                f.write(block)
+                remaining -= len(block)
+            if remaining:
+                f.truncate(offset)
+                raise UploadError("Chunk is incomplete", offset=offset)
+            if checksum and sha256.hexdigest() != checksum.lower():
+                f.truncate(offset)
+                raise UploadError("Chunk checksum mismatch", offset=offset)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return _status(upload_id, path, meta)
+
+
+def get_path(tenant_id, upload_id):
+    """Return the path of a complete upload."""
+    path, meta = _load(tenant_id, upload_id)
+    if not _status(upload_id, path, meta)['complete']:
+        raise UploadError("Upload is not complete", status=409)
+    return os.path.join(path, DATA_FILENAME)
+
+
+def discard(upload_id):
+    try:
+        shutil.rmtree(_upload_path(upload_id), ignore_errors=True)
+    except UploadError:
+        pass
@@ -10,48 +10,460 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import errno
+import hashlib
+import logging
 import math
 import os
+import shutil
+import StringIO
+import struct
+import threading
+import time
 import zipfile
 
+from multiprocessing import pool as mp_pool
+
 from xml.etree import ElementTree
 from lxml import etree
 from tempfile import mkdtemp
 
+from django.conf import settings
+
+from horizon.utils import functions as utils_functions
+
 from openstack_dashboard import api
+from openstack_dashboard.dashboards.project.cloudlet import catalog
+from openstack_dashboard.dashboards.project.cloudlet import overlay_cache
 
 import elijah.provisioning.memory_util as elijah_memory_util
 import glanceclient.exc as glance_exceptions
+import requests
+from novaclient import exceptions as nova_exceptions
+from elijah.provisioning.configuration import Const as Cloudlet_Const
 from elijah.provisioning.package import BaseVMPackage
+from elijah.provisioning.package import VMOverlayPackage
+try:
+    from elijah.provisioning import msgpack
+except ImportError:
+    import msgpack
+
+
+LOG = logging.getLogger(__name__)
+
+_HTTP_SESSION_LOCK = threading.Lock()
+_CLASSIFICATION_LOCK = threading.Lock()
+
+CLOUDLET_IMAGE_TYPES = ('cloudlet_base_disk', 'cloudlet_overlay')
+
+
+def get_image_listing_config():
+    config = {'filter_pushdown': True,
+              'fill_page': True,
+              'max_fill_pages': 10}
+    config.update(getattr(settings, 'CLOUDLET_IMAGE_LISTING', {}))
+    return config
+
+
+def property_filters(properties):
+    # Glance v1 only filters on custom properties through the
+    # "property-" prefix, Glance v2 filters on them directly.
+    if api.glance.VERSIONS.active < 2:
+        return dict(('property-' + key, value)
+                    for key, value in properties.items())
+    return dict(properties)
+
+
+def cloudlet_image_filters(cloudlet_type, owner=None):
+    filters = property_filters({'cloudlet_type': cloudlet_type})
+    # Glance v1 cannot filter on the owner at all.
+    if owner is not None and api.glance.VERSIONS.active >= 2:
+        filters['owner'] = owner
+    return filters
+
+
+def _image_cloudlet_type(image):
+    properties = getattr(image, 'properties', None) or {}
+    return properties.get('cloudlet_type', None)
+
+
+class ImageSnapshot(object):
+    """One Glance listing page of a table.
 
+    When ``filters`` are given they are pushed down to Glance. If
+    ``fill_page`` is set, further pages are fetched until a display page
+    of cloudlet rows is full, in case Glance ignored a filter.
+    """
+    def __init__(self, request, marker=None, reversed_order=False,
+                 filters=None, fill_page=False, max_fill_pages=1):
+        self.request = request
+        self.marker = marker
+        self.reversed_order = reversed_order
+        self.filters = filters
+        self.fill_page = fill_page
+        self.max_fill_pages = max_fill_pages
+        self.images = []
+        self.more = False
+        self.prev = False
 
-def get_cloudlet_type(instance):
-    request = instance.request
-    image_id = getattr(instance.image, 'id', None)
+    def _list(self, marker):
+        return catalog.image_list_detailed(
+            self.request,
+            marker=marker,
+            filters=self.filters,
+            paginate=True,
+            sort_dir='asc',
+            sort_key='name',
+            reversed_order=self.reversed_order)
+
+    def load(self):
+        images, self.more, self.prev = self._list(self.marker)
+        if not self.fill_page:
+            self.images = images
+            return self
+
+        page_size = utils_functions.get_page_size(self.request)
+        rows = [im for im in images
+                if _image_cloudlet_type(im) in CLOUDLET_IMAGE_TYPES]
+        pages = 1
+        while images and self.more and len(rows) < page_size and \
+                pages < self.max_fill_pages:
+            # Pages come back in ascending order even when listed
+            # backwards, so the far end of a reversed page is its head.
+            last = images[0] if self.reversed_order else images[-1]
+            images, self.more, _prev = self._list(last.id)
+            matched = [im for im in images
+                       if _image_cloudlet_type(im) in CLOUDLET_IMAGE_TYPES]
+            if self.reversed_order:
+                rows = matched + rows
+            else:
+                rows = rows + matched
+            pages += 1
+
+        if len(rows) > page_size:
+            self.more = True
+            if self.reversed_order:
+                rows = rows[-page_size:]
+            else:
+                rows = rows[:page_size]
+        self.images = rows
+        return self
+
+    def select(self, cloudlet_type, owner=None):
+        """The images of ``cloudlet_type``, and of ``owner`` if given."""
+        return [image for image in self.images
+                if _image_cloudlet_type(image) == cloudlet_type and
+                (owner is None or image.owner == owner)]
+
+
+def get_image_snapshot(request, marker=None, reversed_order=False,
+                       filters=None):
+    """Return the loaded listing page at ``marker``."""
+    config = get_image_listing_config()
+    return ImageSnapshot(request, marker, reversed_order, filters,
+                         fill_page=config['fill_page'],
+                         max_fill_pages=config['max_fill_pages']).load()
+
+
+def _instance_image_id(instance):
+    image = getattr(instance, 'image', None)
+    if isinstance(image, dict):
+        return image.get('id')
+    return getattr(image, 'id', None)
+
+
+def _classify_instance(instance, image):
+    properties = getattr(image, 'properties', None)
+    if properties is None or properties.get('is_cloudlet') is None:
+        return None
+
+    # now it's either resumed base instance or synthesized instance
+    # synthesized instance has meta that for overlay URL
     metadata = instance.metadata
-    # TODO: glance versoin v1 and v2 is different, so it will change.
+    if (metadata.get('overlay_url') is not None) or \
+            (metadata.get('handoff_info') is not None):
+        return 'cloudlet_overlay'
+    else:
+        return 'cloudlet_base_disk'
+
+
+class TTLCache(object):
+    """Small thread-safe in-process cache with per-entry expiry."""
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires < time.time():
+                del self._data[key]
+                return False, None
+            return True, value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                now = time.time()
+                for k in [k for k, (expires, v) in self._data.items()
+                          if expires < now]:
+                    del self._data[k]
+                if len(self._data) >= self.max_entries:
+                    self._data.clear()
+            self._data[key] = (time.time() + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+_IMAGE_CACHE = TTLCache()
+
+
+def get_image_resolver_config():
+    config = {'cache_ttl': 30,
+              'max_workers': 8}
+    config.update(getattr(settings, 'CLOUDLET_IMAGE_RESOLVER', {}))
+    return config
+
+
+def run_parallel(func, args_list, max_workers):
+    """Call ``func`` with every tuple of ``args_list`` in a thread pool.
+
+    Returns a list of ``(result, exception)`` pairs in the same order.
+    """
+    def call(args):
+        try:
+            return func(*args), None
+        except Exception as e:
+            return None, e
+
+    if len(args_list) < 2 or max_workers < 2:
+        return [call(args) for args in args_list]
+    thread_pool = mp_pool.ThreadPool(
+        processes=min(max_workers, len(args_list)))
     try:
-        if image_id is not None:
-            image = api.glance.image_get(request, image_id)
-            if hasattr(image, 'properties') != True:
-                return None
-            properties = getattr(image, 'properties')
-            if properties is None or properties.get('is_cloudlet') is None:
-                return None
-
-            # now it's either resumed base instance or synthesized instance
-            # synthesized instance has meta that for overlay URL
-            if (metadata.get('overlay_url') is not None) or \
-                    (metadata.get('handoff_info') is not None):
-                return 'cloudlet_overlay'
-            else:
-                return 'cloudlet_base_disk'
+        return thread_pool.map(call, args_list)
+    finally:
+        thread_pool.close()
+
+
+def get_images_by_id(request, image_ids, use_cache=True, with_gone=False):
+    """Return a dict of the given images keyed by image ID.
+
+    Images seen recently by the same project are served from a short-TTL
+    cache. The others are fetched in one listing with an "id in" filter on
+    Glance v2, or concurrently one by one on v1 and for the images the
+    listing left out. Images which cannot be looked up are left out of the
+    result, the ones confirmed gone by a 404 are cached and left out too.
+    ``use_cache=False`` always asks Glance, for callers which poll for
+    status changes. With ``with_gone`` the images confirmed gone, by a 404
+    or their ``deleted`` status, are returned as None.
+    """
+    config = get_image_resolver_config()
+    tenant_id = request.user.tenant_id
+    images = {}
+    missing = set()
+    for image_id in set(str(image_id) for image_id in image_ids):
+        if use_cache:
+            hit, image = _IMAGE_CACHE.get((tenant_id, image_id))
         else:
-            return None
-    except glance_exceptions.ClientException:
+            hit = False
+        if not hit:
+            missing.add(image_id)
+        elif image is not None or with_gone:
+            images[image_id] = image
+    if not missing:
+        return _mark_gone(images) if with_gone else images
+
+    fetched = {}
+    unresolved = missing
+    if api.glance.VERSIONS.active >= 2:
+        try:
+            found, _more, _prev = api.glance.image_list_detailed(
+                request,
+                filters={'id': 'in:' + ','.join(sorted(missing))})
+            found = dict((str(image.id), image) for image in found)
+            if set(found) <= missing:
+                fetched.update(found)
+                # Only its own lookup tells whether an image left out of
+                # the listing is gone.
+                unresolved = missing - set(found)
+            else:
+                LOG.debug("Glance ignored the id filter, fetching images "
+                          "one by one.")
+        except Exception:
+            LOG.debug("Bulk image lookup failed, fetching images one by one.",
+                      exc_info=True)
+
+    gone = set()
+    if unresolved:
+        unresolved = sorted(unresolved)
+        results = run_parallel(api.glance.image_get,
+                               [(request, image_id)
+                                for image_id in unresolved],
+                               config['max_workers'])
+        for image_id, (image, error) in zip(unresolved, results):
+            if isinstance(error, glance_exceptions.HTTPNotFound):
+                gone.add(image_id)
+            elif error is not None:
+                # Do not cache transient failures.
+                LOG.debug("Unable to retrieve image %s: %s", image_id, error)
+            else:
+                fetched[image_id] = image
+
+    for image_id, image in fetched.items():
+        _IMAGE_CACHE.set((tenant_id, image_id), image, config['cache_ttl'])
+    for image_id in gone:
+        _IMAGE_CACHE.set((tenant_id, image_id), None, config['cache_ttl'])
+    images.update(fetched)
+    if with_gone:
+        images.update(dict.fromkeys(gone))
+        return _mark_gone(images)
+    return images
+
+
+def _mark_gone(images):
+    # Glance v1 still returns deleted images, with a "deleted" status.
+    return dict((image_id, None if getattr(image, 'status', None) ==
+                 'deleted' else image)
+                for image_id, image in images.items())
+
+
+_FLAVOR_CACHE = TTLCache()
+
+
+def get_flavor_resolver_config():
+    config = {'cache_ttl': 30,
+              'negative_ttl': 300,
+              'max_workers': 8}
+    config.update(getattr(settings, 'CLOUDLET_FLAVOR_RESOLVER', {}))
+    return config
+
+
+def _fetch_flavor(request, flavor_id):
+    try:
+        return api.nova.flavor_get(request, flavor_id)
+    except nova_exceptions.NotFound:
         return None
 
 
+def get_flavors_by_id(request, flavor_ids):
+    """Return a dict of the given flavors keyed by flavor ID.
+
+    Every distinct flavor is fetched once, in parallel. Deleted or
+    inaccessible flavors are remembered for ``negative_ttl`` seconds so
+    they are not looked up again on every page.
+    """
+    config = get_flavor_resolver_config()
+    tenant_id = request.user.tenant_id
+    flavors = {}
+    missing = []
+    for flavor_id in sorted(set(str(flavor_id) for flavor_id in flavor_ids)):
+        hit, flavor = _FLAVOR_CACHE.get((tenant_id, flavor_id))
+        if not hit:
+            missing.append(flavor_id)
+        elif flavor is not None:
+            flavors[flavor_id] = flavor
+
+    results = run_parallel(_fetch_flavor,
+                           [(request, flavor_id) for flavor_id in missing],
+                           config['max_workers'])
+    for flavor_id, (flavor, error) in zip(missing, results):
+        if error is not None:
+            LOG.info('Unable to retrieve flavor "%s": %s', flavor_id, error)
+        elif flavor is None:
+            _FLAVOR_CACHE.set((tenant_id, flavor_id), None,
+                              config['negative_ttl'])
+        else:
+            _FLAVOR_CACHE.set((tenant_id, flavor_id), flavor,
+                              config['cache_ttl'])
+            flavors[flavor_id] = flavor
+    return flavors
+
+
+def resolve_instance_images(request, instances):
+    image_ids = set()
+    for instance in instances:
+        image_id = _instance_image_id(instance)
+        if image_id is not None:
+            image_ids.add(str(image_id))
+    return get_images_by_id(request, image_ids)
+
+
+def get_classification_stats(request):
+    return getattr(request, 'cloudlet_classification_stats',
+                   {'hits': 0, 'misses': 0})
+
+
+def _classification_cache(request):
+    with _CLASSIFICATION_LOCK:
+        cache = getattr(request, '_cloudlet_classification', None)
+        if cache is None:
+            cache = request._cloudlet_classification = {}
+            request.cloudlet_classification_stats = {'hits': 0, 'misses': 0}
+    return cache
+
+
+def classify_instances(request, instances, image_index=None):
+    """Return a dict mapping instance IDs to their cloudlet type.
+
+    Results are memoized on the request, keyed by instance and image ID,
+    so the table column, the row actions and the row updates classify each
+    instance only once. Images are looked up in ``image_index`` first, the
+    ones missing from it are fetched from Glance once, de-duplicated across
+    all instances.
+    """
+    cache = _classification_cache(request)
+    stats = request.cloudlet_classification_stats
+
+    types = {}
+    pending = []
+    for instance in instances:
+        key = (instance.id, _instance_image_id(instance))
+        if key in cache:
+            stats['hits'] += 1
+            types[instance.id] = cache[key]
+        else:
+            stats['misses'] += 1
+            pending.append(instance)
+    if not pending:
+        return types
+
+    image_index = dict(image_index or {})
+    missing = set()
+    for instance in pending:
+        image_id = _instance_image_id(instance)
+        if image_id is not None and str(image_id) not in image_index:
+            missing.add(str(image_id))
+    if missing:
+        image_index.update(get_images_by_id(request, missing))
+
+    for instance in pending:
+        image_id = _instance_image_id(instance)
+        image = image_index.get(str(image_id)) if image_id else None
+        if image is None:
+            instance_type = None
+        else:
+            instance_type = _classify_instance(instance, image)
+        cache[(instance.id, image_id)] = instance_type
+        types[instance.id] = instance_type
+    LOG.debug("Cloudlet classification stats: %s", stats)
+    return types
+
+
+def get_cloudlet_type(instance, request=None):
+    request = request or instance.request
+    return classify_instances(request, [instance]).get(instance.id)
+
+
 def find_matching_flavor(flavor_list, cpu_count, memory_mb, disk_gb):
     ret = set()
     for flavor in flavor_list:
@@ -66,62 +478,1066 @@ def find_matching_flavor(flavor_list, cpu_count, memory_mb, disk_gb):
     return ret
 
 
+def get_import_config():
+    config = {'streaming': True,
+              'chunk_size': 1024 * 1024,
+              'upload_workers': 4,
+              'verify_integrity': True}
+    config.update(getattr(settings, 'CLOUDLET_BASEVM_IMPORT', {}))
+    return config
+
+
+# Python 2 does not expose these, they are the Linux values.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+ZERO_BLOCK_SIZE = 64 * 1024
+_ZERO_BLOCK = '\0' * ZERO_BLOCK_SIZE
+
+
+def is_zero_block(block):
+    return block == _ZERO_BLOCK[:len(block)]
+
+
+def data_extents(fd, size):
+    """Yield the ``(start, end)`` data extents of a file, skipping holes.
+
+    File systems without SEEK_DATA/SEEK_HOLE support report the whole file
+    as one data extent.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left after offset.
+                return
+            if offset == 0:
+                yield 0, size
+                return
+            raise
+        yield start, min(end, size)
+        offset = end
+
+
+def allocated_size(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        return sum(end - start
+                   for start, end in data_extents(f.fileno(), size))
+
+
+class SparseFileStream(object):
+    """File-like reader which serves holes without reading the disk.
+
+    ``size`` is the logical size of the file and ``allocated_size`` the
+    number of bytes in its data extents.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._extents = list(data_extents(self._file.fileno(), self.size))
+        self.allocated_size = sum(end - start
+                                  for start, end in self._extents)
+        self._index = 0
+        self._pos = 0
+
+    def read(self, size=-1):
+        if self._file is None:
+            return ''
+        remaining = self.size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            self.close()
+            return ''
+
+        while self._index < len(self._extents) and \
+                self._extents[self._index][1] <= self._pos:
+            self._index += 1
+        if self._index < len(self._extents):
+            start, end = self._extents[self._index]
+        else:
+            start = end = self.size
+
+        if self._pos < start:
+            chunk = '\0' * min(size, start - self._pos)
+        else:
+            self._file.seek(self._pos)
+            chunk = self._file.read(min(size, end - self._pos))
+            if not chunk:
+                self.close()
+                return ''
+        self._pos += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+class Sha256Verifier(object):
+    """Check the SHA-256 of the data passed to ``update``."""
+    def __init__(self, expected):
+        self.expected = expected
+        self._sha256 = hashlib.sha256()
+
+    def update(self, chunk):
+        self._sha256.update(chunk)
+
+    def verify(self):
+        digest = self._sha256.hexdigest()
+        if digest != self.expected.lower():
+            raise IntegrityError("SHA-256 mismatch: expected %s, got %s"
+                                 % (self.expected, digest))
+
+
+HASH_LIST_RECORD = struct.Struct('!qq32s')
+
+
+def parse_hash_list(data):
+    """Parse an elijah hash list, as found in the memory_hash member.
+
+    The list is made of ``(start offset, length, SHA-256 digest)``
+    records, one per page of the memory snapshot. Returns the records
+    sorted by offset, or None when ``data`` is not such a list.
+    """
+    size = HASH_LIST_RECORD.size
+    if not data or len(data) % size:
+        return None
+    records = sorted(HASH_LIST_RECORD.unpack_from(data, offset)
+                     for offset in xrange(0, len(data), size))
+    end = 0
+    for start, length, _digest in records:
+        if start < end or length <= 0:
+            return None
+        end = start + length
+    return records
+
+
+class HashListVerifier(object):
+    """Check data passed in order to ``update`` against a hash list.
+
+    Every record of the list is checked as soon as its last byte went
+    through, the bytes between records are not checked.
+    """
+    def __init__(self, records):
+        self.records = records
+        self._index = 0
+        self._pos = 0
+        self._sha256 = hashlib.sha256()
+
+    def update(self, chunk):
+        i = 0
+        while i < len(chunk) and self._index < len(self.records):
+            start, length, digest = self.records[self._index]
+            pos = self._pos + i
+            if pos < start:
+                i += start - pos
+                continue
+            take = min(start + length - pos, len(chunk) - i)
+            self._sha256.update(chunk[i:i + take])
+            i += take
+            if pos + take == start + length:
+                if self._sha256.digest() != digest:
+                    raise IntegrityError("SHA-256 mismatch of the %d bytes "
+                                         "at offset %d" % (length, start))
+                self._sha256 = hashlib.sha256()
+                self._index += 1
+        self._pos += len(chunk)
+
+    def verify(self):
+        if self._index < len(self.records):
+            raise IntegrityError("Data ends at offset %d, before the hashed "
+                                 "bytes at offset %d" %
+                                 (self._pos, self.records[self._index][0]))
+
+
+class ProgressStream(object):
+    """File-like wrapper counting the bytes read from ``stream``.
+
+    When a ``verifier`` is given, such as a Sha256Verifier, it is fed the
+    data on the fly and checked once the stream is exhausted. A mismatch
+    raises IntegrityError from the read which found it, which aborts the
+    upload reading the stream. Setting ``cancel_event`` aborts the next
+    read, ``progress`` is called with the size of every chunk read.
+    """
+    def __init__(self, stream, chunk_size=1024 * 1024,
+                 verifier=None, cancel_event=None, progress=None):
+        self.stream = stream
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.zero_bytes = 0
+        self.verifier = verifier
+        self.cancel_event = cancel_event
+        self._verified = False
+
+    def read(self, size=-1):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise UploadCancelled()
+        chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        if self.progress is not None and chunk:
+            self.progress(len(chunk))
+        for offset in xrange(0, len(chunk), ZERO_BLOCK_SIZE):
+            block = chunk[offset:offset + ZERO_BLOCK_SIZE]
+            if is_zero_block(block):
+                self.zero_bytes += len(block)
+        if self.verifier is not None:
+            self.verifier.update(chunk)
+            if not chunk or size is None or size < 0:
+                self.verify()
+        return chunk
+
+    def verify(self):
+        if self._verified:
+            return
+        self._verified = True
+        self.verifier.verify()
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+
+
+def upload_image_data(request, image_id, stream):
+    client = api.glance.glanceclient(request)
+    if api.glance.VERSIONS.active < 2:
+        client.images.update(image_id, data=stream)
+    else:
+        client.images.upload(image_id, stream)
+
+
+def _upload_component(request, name, image_id, stream,
+                      verifier=None, cancel_event=None, progress=None):
+    stream = ProgressStream(stream,
+                            verifier=verifier,
+                            cancel_event=cancel_event,
+                            progress=progress)
+    start = time.time()
+    try:
+        upload_image_data(request, image_id, stream)
+    except Exception:
+        if cancel_event is not None:
+            cancel_event.set()
+        raise
+    finally:
+        stream.close()
+    elapsed = max(time.time() - start, 0.001)
+    throughput = stream.bytes_read / elapsed / 1024 / 1024
+    # Sparse files know their allocated size, for other streams count the
+    # bytes which were not zero blocks.
+    allocated = getattr(stream.stream, 'allocated_size',
+                        stream.bytes_read - stream.zero_bytes)
+    LOG.info("Uploaded %s (%s): %d bytes logical, %d bytes allocated, "
+             "%d bytes sent in %.1fs, %.1f MB/s",
+             name, image_id, getattr(stream.stream, 'size', stream.bytes_read),
+             allocated, stream.bytes_read, elapsed, throughput)
+    return {'name': name,
+            'image_id': image_id,
+            'logical_size': getattr(stream.stream, 'size', stream.bytes_read),
+            'allocated_size': allocated,
+            'bytes': stream.bytes_read,
+            'seconds': elapsed,
+            'throughput': throughput}
+
+
+def run_uploads(request, uploads, max_workers, progress=None):
+    """Upload the data of several images, return their upload stats.
+
+    ``uploads`` is a list of ``(name, image_id, stream, verifier)``
+    tuples whose images already exist in Glance, ``verifier`` checks the
+    data sent and may be None. ``progress`` is called with the size of
+    every chunk sent.
+
+    If any upload fails, including an integrity check, the remaining ones
+    are cancelled, all the images of the batch are deleted and the first
+    error is raised.
+    """
+    cancel_event = threading.Event()
+    results = run_parallel(
+        _upload_component,
+        [(request, name, image_id, stream, verifier, cancel_event,
+          progress)
+         for name, image_id, stream, verifier in uploads],
+        max_workers)
+    first_error = None
+    for upload, (stats, error) in zip(uploads, results):
+        if error is not None and not isinstance(error, UploadCancelled):
+            first_error = first_error or error
+            LOG.error("Unable to upload %s (%s): %s",
+                      upload[0], upload[1], error)
+    if first_error is not None:
+        for upload in uploads:
+            try:
+                api.glance.image_delete(request, upload[1])
+            except Exception:
+                LOG.warning("Unable to delete image %s", upload[1])
+        catalog.invalidate(catalog.IMAGES)
+        raise first_error
+    return [stats for stats, error in results]
+
+
+def get_download_config():
+    config = {'chunk_size': 1024 * 1024}
+    config.update(getattr(settings, 'CLOUDLET_OVERLAY_DOWNLOAD', {}))
+    return config
+
+
+def parse_byte_range(header, size):
+    """Return the inclusive ``(start, end)`` of a ``Range`` header.
+
+    Only a single ``bytes`` range is supported, None is returned for the
+    headers which should be ignored, invalid ones such as ``bytes=5-3``
+    included. A valid range which cannot be satisfied raises ValueError.
+    """
+    unit, _sep, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            # bytes=-N is the last N bytes.
+            suffix = int(last)
+            start, end = max(size - suffix, 0), size - 1
+            if suffix <= 0:
+                start = size
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first != '' and last and start > end:
+        return None
+    end = min(end, size - 1)
+    if start < 0 or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def _rechunk(body, chunk_size, skip=0, length=None):
+    # Glance hands out chunks of its own size, send fixed-size ones.
+    buffered = []
+    buffered_size = 0
+    try:
+        for data in body:
+            if skip:
+                if len(data) <= skip:
+                    skip -= len(data)
+                    continue
+                data = data[skip:]
+                skip = 0
+            if length is not None:
+                data = data[:length]
+                length -= len(data)
+            buffered.append(data)
+            buffered_size += len(data)
+            if buffered_size >= chunk_size:
+                data = ''.join(buffered)
+                for offset in xrange(0, len(data) - chunk_size + 1,
+                                     chunk_size):
+                    yield data[offset:offset + chunk_size]
+                rest = data[len(data) - len(data) % chunk_size:]
+                buffered = [rest] if rest else []
+                buffered_size = len(rest)
+            if length == 0:
+                break
+        if buffered_size:
+            yield ''.join(buffered)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def _ranged_image_data(request, image_id, start, end):
+    # Glance v2 serves ranges of the image data, the client library
+    # has no call for it.
+    if api.glance.VERSIONS.active < 2:
+        return None, start
+    client = api.glance.glanceclient(request)
+    try:
+        resp, body = client.http_client.get(
+            '/v2/images/%s/file' % image_id,
+            headers={'Range': 'bytes=%d-%d' % (start, end)})
+    except Exception:
+        LOG.debug("Ranged download of image %s failed", image_id,
+                  exc_info=True)
+        return None, start
+    if resp.status_code == 206:
+        return body, 0
+    # The whole image is coming, skip to the range.
+    return body, start
+
+
+def iter_image_data(request, image_id, start=0, end=None):
+    """Iterate over the data of an image in fixed-size chunks.
+
+    ``start`` and ``end`` are the inclusive offsets of the bytes wanted,
+    ``end=None`` reads to the end of the image.
+    """
+    chunk_size = get_download_config()['chunk_size']
+    body = None
+    if end is not None:
+        body, skip = _ranged_image_data(request, image_id, start, end)
+    if body is None:
+        body = api.glance.glanceclient(request).images.data(image_id)
+        skip = start
+    length = None if end is None else end - start + 1
+    return _rechunk(body, chunk_size, skip, length)
+
+
+class ZipMemberStream(object):
+    """File-like object streaming one member out of a zip archive.
+
+    Every stream opens the archive on its own, so several members can be
+    read by concurrent upload threads. The archive is closed as soon as
+    the member has been read to the end.
+    """
+    def __init__(self, archive_path, name, chunk_size=1024 * 1024):
+        self.name = name
+        self.chunk_size = chunk_size
+        self._archive = zipfile.ZipFile(archive_path)
+        self.size = self._archive.getinfo(name).file_size
+        self._member = self._archive.open(name)
+
+    def read(self, size=-1):
+        if self._member is None:
+            return ''
+        chunk = self._member.read(size)
+        if not chunk or size is None or size < 0:
+            self.close()
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self._member is not None:
+            self._member.close()
+            self._archive.close()
+            self._member = None
+
+
+def remember_overlay_origin(request, instance_id, overlay_name):
+    """Record the base VM of the overlay created from ``instance_id``.
+
+    Failures are only logged, the origin is a shortcut for synthesis.
+    """
+    try:
+        instance = api.nova.server_get(request, instance_id)
+        base_image_id = _instance_image_id(instance)
+        base_image = api.glance.image_get(request, base_image_id)
+        properties = getattr(base_image, 'properties', None) or {}
+        catalog.set_overlay_origin(
+            overlay_name,
+            {'base_image_id': base_image_id,
+             'base_sha256': properties.get('base_sha256_uuid')})
+    except Exception:
+        LOG.warning("Unable to record the base VM of %s", overlay_name,
+                    exc_info=True)
+
+
+def store_overlay_origin(request, overlay_image):
+    """Return the base VM SHA-256 of an overlay image, or None.
+
+    The base VM recorded when the overlay was requested is keyed by the
+    overlay name, which can be edited. It is written to the
+    ``base_sha256_uuid`` property of the overlay image as soon as the
+    image is seen, failures are only logged.
+    """
+    properties = getattr(overlay_image, 'properties', None) or {}
+    sha256 = properties.get('base_sha256_uuid')
+    if sha256 or properties.get('cloudlet_type') != 'cloudlet_overlay':
+        return sha256
+    origin = catalog.get_overlay_origin(overlay_image.name) or {}
+    sha256 = origin.get('base_sha256')
+    if not sha256:
+        return None
+    try:
+        if api.glance.VERSIONS.active < 2:
+            api.glance.image_update(request, overlay_image.id,
+                                    properties={'base_sha256_uuid': sha256},
+                                    purge_props=False)
+        else:
+            api.glance.image_update(request, overlay_image.id,
+                                    base_sha256_uuid=sha256)
+        catalog.delete_overlay_origin(overlay_image.name)
+        catalog.invalidate(catalog.IMAGES)
+    except Exception:
+        LOG.warning("Unable to store the base VM of overlay %s",
+                    overlay_image.id, exc_info=True)
+    return sha256
+
+
+def find_overlay_basevm(request, overlay_image):
+    """Return the base disk image an overlay image applies to, or None.
+
+    Uses the ``base_sha256_uuid`` property of the overlay, which is set
+    from the origin recorded when the overlay was requested if needed.
+    """
+    sha256 = store_overlay_origin(request, overlay_image)
+    return find_basevm_by_sha256(request, sha256)
+
+
+def get_remote_zip_config():
+    config = {'block_size': 16 * 1024,
+              'byte_budget': 4 * 1024 * 1024,
+              'pool_maxsize': 10,
+              'timeout': 30}
+    config.update(getattr(settings, 'CLOUDLET_REMOTE_ZIP', {}))
+    return config
+
+
+_HTTP_SESSION = None
+
+
+def get_http_session():
+    """Return the HTTP session shared for fetching remote overlays."""
+    global _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            pool_maxsize = get_remote_zip_config()['pool_maxsize']
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _HTTP_SESSION = session
+        return _HTTP_SESSION
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class ByteBudgetExceeded(Exception):
+    pass
+
+
+class RemoteFile(object):
+    """Read-only, seekable file over HTTP Range requests.
+
+    Reads are served from a block fetched with one Range request, at least
+    ``block_size`` bytes long. The archive tail is fetched first, it holds
+    the zip end of central directory record and tells the size. Fetching
+    more than ``byte_budget`` bytes in total raises ByteBudgetExceeded.
+    """
+    def __init__(self, url, session=None, block_size=None, byte_budget=None,
+                 timeout=None):
+        config = get_remote_zip_config()
+        self.url = url
+        self.session = session or get_http_session()
+        self.block_size = block_size or config['block_size']
+        self.byte_budget = byte_budget or config['byte_budget']
+        self.timeout = timeout or config['timeout']
+        self.bytes_fetched = 0
+        self.size = None
+        self._pos = 0
+        self._block_start = 0
+        self._block = ''
+        self._fetch('bytes=-%d' % self.block_size, self.block_size)
+        self._block_start = self.size - len(self._block)
+
+    def _fetch(self, byte_range, length):
+        if self.bytes_fetched + length > self.byte_budget:
+            raise ByteBudgetExceeded("Reading %s needs more than %d bytes"
+                                     % (self.url, self.byte_budget))
+        resp = self.session.get(self.url, headers={'Range': byte_range},
+                                stream=True, timeout=self.timeout)
+        try:
+            content_range = resp.headers.get('Content-Range', '')
+            if resp.status_code != 206 or '/' not in content_range:
+                raise RangeNotSupported("%s: HTTP %d without a byte range"
+                                        % (self.url, resp.status_code))
+            self.size = int(content_range.rsplit('/', 1)[1])
+            self._block = resp.raw.read(length + 1,
+                                        decode_content=True)[:length]
+        finally:
+            resp.close()
+        self.bytes_fetched += len(self._block)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid offset")
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        if size <= 0:
+            return ''
+        block_end = self._block_start + len(self._block)
+        if not self._block_start <= self._pos or self._pos + size > block_end:
+            length = min(max(size, self.block_size), self.size - self._pos)
+            self._fetch('bytes=%d-%d' % (self._pos, self._pos + length - 1),
+                        length)
+            self._block_start = self._pos
+        offset = self._pos - self._block_start
+        data = self._block[offset:offset + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._block = ''
+
+
+OVERLAY_META_NAME = getattr(Cloudlet_Const, 'OVERLAY_META', 'overlay-meta')
+
+
+def read_remote_overlay_meta(overlay_url):
+    """Return the raw metadata member of a remote overlay package.
+
+    Only the end of the archive, its central directory and the metadata
+    member are fetched with Range requests. Servers which do not serve
+    ranges, and packages laid out differently, are read by
+    VMOverlayPackage instead.
+    """
+    try:
+        remote = RemoteFile(overlay_url)
+    except RangeNotSupported:
+        LOG.info("%s is not served by ranges, reading the whole header",
+                 overlay_url)
+        return VMOverlayPackage(overlay_url).read_meta()
+    try:
+        archive = zipfile.ZipFile(remote)
+        try:
+            return archive.read(OVERLAY_META_NAME)
+        except KeyError:
+            LOG.warning("No %s member in %s", OVERLAY_META_NAME, overlay_url)
+            return VMOverlayPackage(overlay_url).read_meta()
+    finally:
+        LOG.debug("Read the metadata of %s (%d bytes) with %d bytes fetched",
+                  overlay_url, remote.size, remote.bytes_fetched)
+        remote.close()
+
+
+def get_overlay_meta_config():
+    config = {'timeout': 86400,
+              'request_timeout': 30}
+    config.update(getattr(settings, 'CLOUDLET_OVERLAY_META', {}))
+    return config
+
+
+class OverlayUnavailable(Exception):
+    pass
+
+
+def read_overlay_meta(overlay_url):
+    """Return the unpacked metadata of the VM overlay at ``overlay_url``.
+
+    The metadata is cached with the ETag and Last-Modified of the overlay.
+    A conditional HEAD revalidates it, the overlay is only read again when
+    it changed or the server sends no validators. Raises
+    OverlayUnavailable when the URL cannot be accessed.
+    """
+    config = get_overlay_meta_config()
+    cached = catalog.get_overlay_meta(overlay_url)
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        resp = get_http_session().head(overlay_url, headers=headers,
+                                       allow_redirects=True,
+                                       timeout=config['request_timeout'])
+    except requests.RequestException as e:
+        raise OverlayUnavailable(str(e))
+    if cached is not None and resp.status_code == 304:
+        return cached['meta']
+    if not resp.ok:
+        raise OverlayUnavailable("HTTP %d" % resp.status_code)
+
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    # Some servers ignore conditional HEAD requests.
+    if cached is not None and (etag or last_modified) and \
+            cached.get('etag') == etag and \
+            cached.get('last_modified') == last_modified:
+        return cached['meta']
+
+    meta = msgpack.unpackb(read_remote_overlay_meta(overlay_url))
+    if etag or last_modified:
+        catalog.set_overlay_meta(overlay_url,
+                                 {'etag': etag,
+                                  'last_modified': last_modified,
+                                  'meta': meta},
+                                 config['timeout'])
+    return meta
+
+
+def share_overlay_image(request, image, expires, progress=None):
+    """Put the overlay ``image`` in the overlay cache for compute nodes.
+
+    Compute nodes have no token to read Glance with, they fetch the overlay
+    from the published overlay cache instead. The cache entry is pinned
+    until the time ``expires``, the caller may unpin it earlier. Returns
+    the pin and the URL compute nodes fetch the overlay from until
+    ``expires``. ``progress`` is called with the size of every chunk read
+    from Glance. Raises OverlayUnavailable when the overlay cannot be
+    shared this way, e.g. when it does not fit in the cache.
+    """
+    image_id = image.id
+    checksum = getattr(image, 'checksum', None) or ''
+    size = getattr(image, 'size', None)
+    cache = overlay_cache.get_cache()
+    url = overlay_cache.get_public_url(image_id, checksum, expires)
+    if cache is None or url is None or size is None or \
+            size > cache.max_size:
+        raise OverlayUnavailable("VM overlay %s cannot be shared" % image_id)
+    pin = cache.pin(image_id, checksum, expires)
+    try:
+        cached = cache.lookup(image_id, checksum, size)
+        if cached is None:
+            for chunk in cache.fill(image_id, checksum, size,
+                                    iter_image_data(request, image_id)):
+                if progress is not None:
+                    progress(len(chunk))
+            cached = cache.lookup(image_id, checksum, size)
+            if cached is None:
+                raise OverlayUnavailable("Unable to cache VM overlay %s"
+                                         % image_id)
+        cached.close()
+    except Exception:
+        cache.unpin(pin)
+        raise
+    return pin, url
+
+
+def get_basevm_index_config():
+    config = {'property_filter': True,
+              'refresh_interval': 30,
+              'full_refresh_interval': 600}
+    config.update(getattr(settings, 'CLOUDLET_BASEVM_INDEX', {}))
+    return config
+
+
+def _basevm_sha256(image):
+    properties = getattr(image, 'properties', None) or {}
+    if properties.get('cloudlet_type') != 'cloudlet_base_disk':
+        return None
+    return properties.get('base_sha256_uuid')
+
+
+class BaseVMIndex(object):
+    """In-process map from base_sha256_uuid to the public base disk image.
+
+    The map is rebuilt from a full listing every ``full_refresh_interval``
+    seconds, after ``invalidate`` and as soon as the catalog cache was
+    invalidated by any process, e.g. when an image was deleted: Glance v2
+    does not list deleted images, so only a full listing drops them. In
+    between, only the images changed since the last refresh are listed, at
+    most every ``refresh_interval`` seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._images = {}
+        self._checked_at = 0
+        self._full_at = 0
+        self._since = None
+        self._generation = None
+
+    def invalidate(self):
+        with self._lock:
+            self._full_at = 0
+
+    def _changed_filters(self, since):
+        if api.glance.VERSIONS.active < 2:
+            return {'changes-since': since}
+        return {'updated_at': 'gte:' + since}
+
+    def refresh(self, request):
+        config = get_basevm_index_config()
+        now = time.time()
+        generation = catalog.get_generation(catalog.IMAGES)
+        full = now - self._full_at > config['full_refresh_interval'] or \
+            generation != self._generation
+        if not full and now - self._checked_at < config['refresh_interval']:
+            return
+
+        filters = {'is_public': True}
+        filters.update(cloudlet_image_filters('cloudlet_base_disk'))
+        if full:
+            filters['status'] = 'active'
+        else:
+            filters.update(self._changed_filters(self._since))
+        # Leave a margin for clock skew between us and Glance.
+        since = datetime.datetime.utcfromtimestamp(now - 60).strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+        images, _more, _prev = api.glance.image_list_detailed(
+            request, filters=filters)
+
+        with self._lock:
+            if full:
+                self._images = {}
+                self._full_at = now
+            for image in images:
+                sha256 = _basevm_sha256(image)
+                if sha256 is None:
+                    continue
+                if image.status == 'active':
+                    self._images[sha256] = image
+                elif getattr(self._images.get(sha256), 'id', None) == \
+                        image.id:
+                    del self._images[sha256]
+            self._checked_at = now
+            self._since = since
+            self._generation = generation
+
+    def lookup(self, request, sha256):
+        self.refresh(request)
+        return self._images.get(sha256)
+
+
+BASEVM_INDEX = BaseVMIndex()
+
+
+def find_basevm_by_sha256(request, sha256):
+    """Return the public base disk image built from ``sha256``, or None.
+
+    Glance is asked for the image with a property filter. If the filter
+    is disabled, fails, or is ignored by Glance, the lookup falls back to
+    the in-process BASEVM_INDEX.
+    """
+    if not sha256:
+        return None
+    if get_basevm_index_config()['property_filter']:
+        filters = {'is_public': True, 'status': 'active'}
+        filters.update(property_filters(
+            {'cloudlet_type': 'cloudlet_base_disk',
+             'base_sha256_uuid': sha256}))
+        try:
+            images, _more, _prev = catalog.image_list_detailed(
+                request, filters=filters)
+            matching = [image for image in images
+                        if _basevm_sha256(image) == sha256]
+            if len(matching) == len(images):
+                return matching[0] if matching else None
+            LOG.debug("Glance ignored the base_sha256_uuid filter.")
+        except Exception:
+            LOG.debug("Base VM property filter lookup failed.",
+                      exc_info=True)
+    return BASEVM_INDEX.lookup(request, sha256)
+
+
+_MANIFEST_PARSERS = threading.local()
+
+
+def get_manifest_parser():
+    # lxml parsers must not be shared between threads, so every thread
+    # compiles the schema-validating parser once and keeps it.
+    parser = getattr(_MANIFEST_PARSERS, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(schema=BaseVMPackage.schema)
+        _MANIFEST_PARSERS.parser = parser
+    return parser
+
+
 class BaseVMs():
+    """A base VM package, opened once and carried from clean to handle.
+
+    The parsed manifest, the member paths and the hash value are cached
+    on the object after the first access.
+    """
+    temp_dir = None
+    archive_path = None
+    zipbase = None
+    _manifest = None
+    _paths = None
+
     def zipfile(self, imagefile):
+        if self.zipbase is not None:
+            return True
         is_zipfile = False
         if zipfile.is_zipfile(imagefile):
             self.zipbase = zipfile.ZipFile(imagefile)
+            if hasattr(imagefile, 'temporary_file_path'):
+                self.archive_path = imagefile.temporary_file_path()
+            elif isinstance(imagefile, basestring):
+                self.archive_path = imagefile
             is_zipfile = True
         return is_zipfile
 
     def xml_data(self):
+        if self._manifest is not None:
+            return self._manifest
         if BaseVMPackage.MANIFEST_FILENAME in self.zipbase.namelist():
             xml = self.zipbase.read(BaseVMPackage.MANIFEST_FILENAME)
-            tree = etree.fromstring(xml,
-                                    etree.XMLParser(
-                                        schema=BaseVMPackage.schema
-                                    ))
-            return tree
+            self._manifest = etree.fromstring(xml, get_manifest_parser())
+            return self._manifest
         return None
 
-    def path(self, tree):
+    def path(self, tree=None):
+        if tree is None or tree is self._manifest:
+            if self._paths is not None:
+                return dict(self._paths)
+            tree = self.xml_data()
         data = dict()
         if tree is not None:
             data['disk'] = tree.find(BaseVMPackage.NSP + 'disk').get('path')
             data['memory'] = tree.find(BaseVMPackage.NSP + 'memory').get('path')
             data['diskhash'] = tree.find(BaseVMPackage.NSP + 'disk_hash').get('path')
             data['memhash'] = tree.find(BaseVMPackage.NSP + 'memory_hash').get('path')
+            if tree is self._manifest:
+                self._paths = dict(data)
         return data
 
+    @property
+    def hash_value(self):
+        tree = self.xml_data()
+        if tree is None:
+            return None
+        return tree.get('hash_value')
+
     def is_exist(self, request, base_hashvalue):
-        image_detail = api.glance.image_list_detailed(request,
-                                                      filters={
-                                                          "is_public": True,
-                                                          "status": "active"})[0]
-
-        for image in image_detail:
-            properties = getattr(image, "properties")
-            if properties is None or len(properties) == 0:
-                continue
-            if properties.get("cloudlet_type") != "cloudlet_base_disk":
-                continue
-            base_sha256_uuid = properties.get("base_sha256_uuid")
-            if base_sha256_uuid == base_hashvalue:
-                return image
-        return None
+        return find_basevm_by_sha256(request, base_hashvalue)
 
     def unzip(self):
         temp_dir = mkdtemp(prefix="cloudlet-base-")
-        self.zipbase.extractall(temp_dir)
+        disk = self.path().get('disk')
+        for name in self.zipbase.namelist():
+            if name == disk:
+                self._extract_sparse(name, temp_dir)
+            else:
+                self.zipbase.extract(name, temp_dir)
+        self.temp_dir = temp_dir
         return temp_dir
 
+    def _extract_sparse(self, name, temp_dir):
+        # Leave holes for the zero blocks of the disk instead of writing
+        # them, base disks are mostly empty.
+        dest = os.path.realpath(os.path.join(temp_dir, name))
+        if not dest.startswith(os.path.realpath(temp_dir) + os.sep):
+            raise ValueError("Invalid member name %s" % name)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        member = self.zipbase.open(name)
+        try:
+            with open(dest, 'wb') as out:
+                while True:
+                    block = member.read(ZERO_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if is_zero_block(block):
+                        out.seek(len(block), os.SEEK_CUR)
+                    else:
+                        out.write(block)
+                out.truncate()
+        finally:
+            member.close()
+
+    def open_member(self, name):
+        """Return a file-like object with the data of an archive member.
+
+        Extracted members are opened from the temporary directory, the
+        others are streamed straight out of the uploaded archive.
+        """
+        if self.temp_dir is not None:
+            return SparseFileStream(os.path.join(self.temp_dir, name))
+        if self.archive_path is not None:
+            return ZipMemberStream(self.archive_path, name,
+                                   get_import_config()['chunk_size'])
+        # Small uploads are kept in memory by Django and have no path.
+        return StringIO.StringIO(self.zipbase.read(name))
+
+    def memory_hash_list(self):
+        """Return the records of the memory_hash member, or None."""
+        stream = self.open_member(self.path()['memhash'])
+        try:
+            return parse_hash_list(stream.read())
+        finally:
+            stream.close()
+
+    def member_size(self, name):
+        if self.temp_dir is not None:
+            return os.path.getsize(os.path.join(self.temp_dir, name))
+        return self.zipbase.getinfo(name).file_size
+
+    def member_allocated_size(self, name):
+        # Only known up front for extracted members, streamed members are
+        # measured while they are uploaded.
+        if self.temp_dir is not None:
+            return allocated_size(os.path.join(self.temp_dir, name))
+        return None
+
+    def cleanup(self):
+        if self.temp_dir is not None and os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+        self.temp_dir = None
+        if self.zipbase is not None:
+            self.zipbase.close()
+            self.zipbase = None
+
     def min_disk(self, disk_path):
-        return int(math.ceil(os.path.getsize(disk_path)/1024/1024/1024))
+        return self.size_to_gb(os.path.getsize(disk_path))
+
+    @staticmethod
+    def size_to_gb(size):
+        return int(math.ceil(size / float(1024 ** 3)))
 
 
 class QemuMemory():
     def libvirt_xml(self, memory_path):
-        return elijah_memory_util._QemuMemoryHeader(open(memory_path)).xml
+        with open(memory_path, 'rb') as memory:
+            return self.libvirt_xml_from_stream(memory)
+
+    def libvirt_xml_from_stream(self, stream):
+        # Only read the fixed header and the XML which follows it, the
+        # header parser needs to seek so it gets an in-memory copy.
+        header_class = elijah_memory_util._QemuMemoryHeader
+        header = stream.read(header_class.HEADER_LENGTH)
+        if len(header) < header_class.HEADER_LENGTH:
+            raise ValueError("Memory snapshot header is truncated")
+        xml_len = struct.unpack(header_class.HEADER_FORMAT, header)[2]
+        header += stream.read(xml_len)
+        return header_class(StringIO.StringIO(header)).xml
+
+    def read_header(self, source):
+        """Return the libvirt XML, vCPU count and memory size (MB).
+
+        ``source`` is the path of a memory snapshot or a file-like object
+        positioned at its start, such as a zip member. Only the header and
+        the XML are read, whatever the size of the snapshot.
+        """
+        if isinstance(source, basestring):
+            libvirt_xml_str = self.libvirt_xml(source)
+        else:
+            libvirt_xml_str = self.libvirt_xml_from_stream(source)
+        cpu_count, memory_mb = self.get_resource_size(libvirt_xml_str)
+        return libvirt_xml_str, cpu_count, memory_mb
 
     def get_resource_size(self, libvirt_xml_str):
         libvirt_xml = ElementTree.fromstring(libvirt_xml_str)
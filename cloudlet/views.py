@@ -12,8 +12,16 @@
 
 from collections import OrderedDict
 import logging
+from multiprocessing import pool as mp_pool
+from multiprocessing import TimeoutError
+import sys
+import threading
+import time
 
+from django.conf import settings
+from django.contrib import messages as django_messages
 from django.utils.translation import ugettext_lazy as _
+import six
 
 from horizon import exceptions
 from horizon import messages
@@ -22,6 +30,8 @@ from horizon import tables
 from openstack_dashboard import api
 from openstack_dashboard import policy
 
+from openstack_dashboard.dashboards.project.cloudlet import catalog
+from openstack_dashboard.dashboards.project.cloudlet import jobs
 from openstack_dashboard.dashboards.project.cloudlet import utils
 from openstack_dashboard.dashboards.project.cloudlet.images \
     import tables as images_tables
@@ -31,86 +41,293 @@ from openstack_dashboard.dashboards.project.cloudlet.instances \
 
 LOG = logging.getLogger(__name__)
 
+AUTH_EXCEPTIONS = (exceptions.NotAuthorized, exceptions.NotAuthenticated,
+                   exceptions.Http302) + \
+    tuple(exceptions.UNAUTHORIZED)
 
-class IndexView(tables.MultiTableView):
+
+class _DeferredRequest(object):
+    """Request seen by a table loader running in a worker thread.
+
+    Attributes are read from the real request, but the ones set by the
+    loaders are kept in ``attrs``, which the loaders of a page share. The
+    messages are collected and only added to the real request by the
+    request thread. A loader which timed out thus leaves no trace in the
+    request or the response.
+    """
+    def __init__(self, request, attrs):
+        horizon = dict(getattr(request, 'horizon', {}), async_messages=[])
+        self.__dict__.update(_request=request,
+                             _attrs=attrs,
+                             _messages=_MessageCollector(),
+                             horizon=horizon)
+
+    def __getattr__(self, name):
+        try:
+            return self._attrs[name]
+        except KeyError:
+            return getattr(self._request, name)
+
+    def __setattr__(self, name, value):
+        self._attrs[name] = value
+
+    def apply(self):
+        for level, message, extra_tags in self._messages.messages:
+            django_messages.add_message(self._request, level, message,
+                                        extra_tags, fail_silently=True)
+        async_messages = self.horizon['async_messages']
+        if async_messages:
+            self._request.horizon['async_messages'].extend(async_messages)
+
+
+class _MessageCollector(object):
+    def __init__(self):
+        self.messages = []
+
+    def add(self, level, message, extra_tags=''):
+        self.messages.append((level, message, extra_tags))
+
+
+class ConcurrentMultiTableView(tables.MultiTableView):
+    """MultiTableView which loads the data of its tables in parallel.
+
+    Every ``get_<table>_data`` method runs in a bounded thread pool, so the
+    page latency is set by the slowest backend instead of the sum of all
+    of them. A table whose loader fails or exceeds its timeout is rendered
+    empty without affecting the other tables. Loaders only see a
+    ``_DeferredRequest``, their messages and pagination are applied by the
+    request thread once they returned in time. Authentication errors are
+    raised again in the request thread so Horizon redirects to the login.
+
+    The behaviour is tuned with the ``CLOUDLET_CONCURRENT_TABLES`` setting::
+
+        CLOUDLET_CONCURRENT_TABLES = {
+            'enabled': True,
+            'max_workers': 4,
+            'timeout': 30,
+            'table_timeouts': {'instances': 60},
+        }
+    """
+    concurrent_defaults = {
+        'enabled': True,
+        'max_workers': 4,
+        'timeout': 30,
+        'table_timeouts': {},
+    }
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super(ConcurrentMultiTableView, self).__init__(*args, **kwargs)
+        self._more = {}
+        self._prev = {}
+
+    @property
+    def request(self):
+        return getattr(self._local, 'request', None) or self._request
+
+    @request.setter
+    def request(self, request):
+        self._request = request
+
+    def get_concurrent_config(self):
+        config = dict(self.concurrent_defaults)
+        config.update(getattr(settings, 'CLOUDLET_CONCURRENT_TABLES', {}))
+        return config
+
+    def set_pagination(self, table_name, more=False, prev=False):
+        pagination = getattr(self._local, 'pagination', None)
+        if pagination is None:
+            self._more[table_name] = more
+            self._prev[table_name] = prev
+        else:
+            pagination[table_name] = (more, prev)
+
+    def has_prev_data(self, table):
+        return self._prev.get(table._meta.name, False)
+
+    def has_more_data(self, table):
+        return self._more.get(table._meta.name, False)
+
+    def _load_table(self, func_list, attrs):
+        # Runs in a worker thread, returns (data, exc_info, pagination,
+        # deferred request) for the request thread to apply.
+        deferred = self._local.request = _DeferredRequest(self._request,
+                                                          attrs)
+        pagination = self._local.pagination = {}
+        try:
+            data = []
+            for func in func_list:
+                data.extend(func())
+            return data, None, pagination, deferred
+        except Exception:
+            return [], sys.exc_info(), pagination, deferred
+        finally:
+            del self._local.request
+            del self._local.pagination
+
+    def _get_data_dict(self):
+        config = self.get_concurrent_config()
+        if self._data or not config['enabled'] or len(self.table_classes) < 2:
+            return super(ConcurrentMultiTableView, self)._get_data_dict()
+
+        verbose_names = OrderedDict((table._meta.name,
+                                     table._meta.verbose_name)
+                                    for table in self.table_classes)
+        workers = max(1, min(int(config['max_workers']), len(verbose_names)))
+        thread_pool = mp_pool.ThreadPool(processes=workers)
+        results = OrderedDict()
+        attrs = {}
+        try:
+            start = time.time()
+            for name in verbose_names:
+                results[name] = thread_pool.apply_async(
+                    self._load_table,
+                    (self._data_methods.get(name, []), attrs))
+            for name, result in results.items():
+                timeout = config['table_timeouts'].get(name,
+                                                       config['timeout'])
+                remaining = max(0, start + timeout - time.time())
+                try:
+                    data, exc_info, pagination, deferred = \
+                        result.get(remaining)
+                except TimeoutError:
+                    LOG.warning('Timed out after %ss loading the "%s" table.',
+                                timeout, name)
+                    self._data[name] = []
+                    self.set_pagination(name)
+                    messages.warning(self.request,
+                                     _('Timed out while retrieving %s.')
+                                     % verbose_names[name])
+                    continue
+                deferred.apply()
+                for table_name, (more, prev) in pagination.items():
+                    self.set_pagination(table_name, more, prev)
+                if exc_info is not None:
+                    if issubclass(exc_info[0], AUTH_EXCEPTIONS):
+                        six.reraise(*exc_info)
+                    LOG.error('Unable to load the "%s" table.', name,
+                              exc_info=exc_info)
+                    data = []
+                    self.set_pagination(name)
+                    messages.error(self.request,
+                                   _('Unable to retrieve %s.')
+                                   % verbose_names[name])
+                self._data[name] = data
+        finally:
+            thread_pool.close()
+            if not all(result.ready() for result in results.values()):
+                # A hung backend call must not block the response, the
+                # pool is joined once it returns.
+                reaper = threading.Thread(target=thread_pool.join)
+                reaper.daemon = True
+                reaper.start()
+            else:
+                thread_pool.join()
+        return self._data
+
+
+class IndexView(ConcurrentMultiTableView):
     table_classes = (images_tables.BaseVMsTable,
                      images_tables.VMOverlaysTable,
                      instances_tables.InstancesTable)
     template_name = 'project/cloudlet/index.html'
     page_title = _("Cloudlet")
 
-    def has_prev_data(self, table):
-        return getattr(self, "_prev", False)
-
-    def has_more_data(self, table):
-        return getattr(self, "_more", False)
-
-    def get_images_data(self):
-        if not policy.check((("image", "get_images"),), self.request):
-            msg = _("Insufficient privilege level to retrieve image list.")
-            messages.info(self.request, msg)
-            return []
+    def _get_image_snapshot(self, table, cloudlet_type, owner=None):
         prev_marker = self.request.GET.get(
-            images_tables.BaseVMsTable._meta.prev_pagination_param, None)
+            table._meta.prev_pagination_param, None)
 
         if prev_marker is not None:
             marker = prev_marker
         else:
             marker = self.request.GET.get(
-                images_tables.BaseVMsTable._meta.pagination_param, None)
+                table._meta.pagination_param, None)
         reversed_order = prev_marker is not None
+        filters = None
+        if utils.get_image_listing_config()['filter_pushdown']:
+            filters = utils.cloudlet_image_filters(cloudlet_type, owner)
+        return utils.get_image_snapshot(self.request,
+                                        marker=marker,
+                                        reversed_order=reversed_order,
+                                        filters=filters)
+
+    def get_images_data(self):
+        if not policy.check((("image", "get_images"),), self.request):
+            msg = _("Insufficient privilege level to retrieve image list.")
+            messages.info(self.request, msg)
+            return []
         try:
-            all_images, self._more, self._prev = api.glance.image_list_detailed(
-                self.request,
-                marker=marker,
-                paginate=True,
-                sort_dir='asc',
-                sort_key='name',
-                reversed_order=reversed_order)
-            images = [im for im in all_images
-                      if im.properties.get("cloudlet_type", None) == 'cloudlet_base_disk']
+            snapshot = self._get_image_snapshot(images_tables.BaseVMsTable,
+                                                'cloudlet_base_disk')
+            self.set_pagination('images', snapshot.more, snapshot.prev)
+            images = snapshot.select('cloudlet_base_disk')
         except Exception:
             images = []
-            self._prev = self._more = False
+            self.set_pagination('images')
             exceptions.handle(self.request, _("Unable to retrieve images."))
-        return images
+        return self._get_import_jobs() + images
+
+    def _get_import_jobs(self):
+        # Running imports are listed above the images of the first page.
+        meta = images_tables.BaseVMsTable._meta
+        if self.request.GET.get(meta.pagination_param) or \
+                self.request.GET.get(meta.prev_pagination_param):
+            return []
+        try:
+            store = jobs.get_store()
+            return [jobs.Job(job) for job in store.list_visible(
+                self.request.user.tenant_id, jobs.IMPORT_BASE_VM)]
+        except Exception:
+            LOG.exception("Unable to retrieve the import jobs.")
+            return []
 
     def get_overlays_data(self):
         if not policy.check((("image", "get_images"),), self.request):
             msg = _("Insufficient privilege level to retrieve image list.")
             messages.info(self.request, msg)
             return []
-        prev_marker = self.request.GET.get(
-            images_tables.VMOverlaysTable._meta.prev_pagination_param, None)
-
-        if prev_marker is not None:
-            marker = prev_marker
-        else:
-            marker = self.request.GET.get(
-                images_tables.VMOverlaysTable._meta.pagination_param, None)
-        reversed_order = prev_marker is not None
         try:
-            all_snaps, self._more, self._prev = api.glance.image_list_detailed(
-                self.request,
-                marker=marker,
-                paginate=True,
-                sort_dir='asc',
-                sort_key='name',
-                reversed_order=reversed_order)
-            snaps = [im for im in all_snaps \
-                     if (im.properties.get("cloudlet_type", None) == "cloudlet_overlay")
-                            and (im.owner == self.request.user.tenant_id)]
+            snapshot = self._get_image_snapshot(
+                images_tables.VMOverlaysTable,
+                'cloudlet_overlay',
+                owner=self.request.user.tenant_id)
+            self.set_pagination('overlays', snapshot.more, snapshot.prev)
+            snaps = snapshot.select('cloudlet_overlay',
+                                    owner=self.request.user.tenant_id)
         except Exception:
             snaps = []
-            self._prev = self._more = False
+            self.set_pagination('overlays')
             exceptions.handle(self.request, _("Unable to retrieve images."))
         return snaps
 
+    def _report_synthesis_jobs(self):
+        # Instances synthesized from an overlay image only show up once
+        # their job launched them, until then the jobs are reported.
+        try:
+            store = jobs.get_store()
+            visible = store.list_visible(self.request.user.tenant_id,
+                                         jobs.SYNTHESIZE_OVERLAY)
+        except Exception:
+            LOG.exception("Unable to retrieve the synthesis jobs.")
+            return
+        for job in visible:
+            if job['status'] == jobs.RUNNING:
+                messages.info(self.request,
+                              _('Synthesizing %s.') % jobs.Job(job).name)
+            else:
+                messages.error(self.request,
+                               _('Unable to synthesize %(name)s: '
+                                 '%(reason)s.') %
+                               {'name': job['name'],
+                                'reason': job['message'] or job['status']})
+
     def get_instances_data(self):
+        self._report_synthesis_jobs()
         try:
-            instances, self._more = api.nova.server_list(self.request)
+            instances, more = api.nova.server_list(self.request)
+            self.set_pagination('instances', more)
         except Exception:
-            self._more = False
+            self.set_pagination('instances')
             instances = []
             exceptions.handle(self.request,
                               _('Unable to retrieve instances.'))
@@ -127,23 +344,32 @@ class IndexView(tables.MultiTableView):
 
             # Gather our flavors and images and correlate our instances to them
             try:
-                flavors = api.nova.flavor_list(self.request)
+                flavors = catalog.flavor_list(self.request)
             except Exception:
                 flavors = []
                 exceptions.handle(self.request, ignore=True)
 
+            # Only resolve the images referenced by this page of instances.
             try:
-                # TODO(gabriel): Handle pagination.
-                images, more, prev = api.glance.image_list_detailed(
-                    self.request)
+                image_map = utils.resolve_instance_images(self.request,
+                                                          instances)
             except Exception:
-                images = []
+                image_map = {}
                 exceptions.handle(self.request, ignore=True)
 
             full_flavors = OrderedDict([(str(flavor.id), flavor)
                                         for flavor in flavors])
-            image_map = OrderedDict([(str(image.id), image)
-                                     for image in images])
+
+            # If a flavor_id is not in the full_flavors list, get it via
+            # the nova api, once per distinct flavor.
+            missing_flavors = set()
+            for instance in instances:
+                flavor_id = str(instance.flavor.get("id"))
+                if flavor_id not in full_flavors:
+                    missing_flavors.add(flavor_id)
+            if missing_flavors:
+                full_flavors.update(
+                    utils.get_flavors_by_id(self.request, missing_flavors))
 
             # Loop through instances to get flavor info.
             for instance in instances:
@@ -153,27 +379,25 @@ class IndexView(tables.MultiTableView):
                         if instance.image.get('id') in image_map:
                             instance.image = image_map[instance.image['id']]
 
-                try:
-                    flavor_id = instance.flavor["id"]
-                    if flavor_id in full_flavors:
-                        instance.full_flavor = full_flavors[flavor_id]
-                    else:
-                        # If the flavor_id is not in full_flavors list,
-                        # get it via nova api.
-                        instance.full_flavor = api.nova.flavor_get(
-                            self.request, flavor_id)
-                except Exception:
+                flavor_id = str(instance.flavor.get("id"))
+                if flavor_id in full_flavors:
+                    instance.full_flavor = full_flavors[flavor_id]
+                else:
                     msg = ('Unable to retrieve flavor "%s" for instance "%s".'
                            % (flavor_id, instance.id))
                     LOG.info(msg)
 
+            instance_types = utils.classify_instances(self.request,
+                                                      instances,
+                                                      image_map)
+            LOG.debug("Cloudlet classification stats: %s",
+                      utils.get_classification_stats(self.request))
             for instance in instances:
-                instance_type = utils.get_cloudlet_type(instance)
-                if instance_type == 'cloudlet_base_disk':
-                    filtered_instances.append(instance)
-                    setattr(instance, 'cloudlet_type', "Resumed Base VM")
-                if instance_type == 'cloudlet_overlay':
+                instance_type = instance_types.get(instance.id)
+                if instance_type in instances_tables.CLOUDLET_TYPE_DISPLAY:
                     filtered_instances.append(instance)
-                    setattr(instance, 'cloudlet_type', "Provisioned VM")
+                    setattr(instance, 'cloudlet_type',
+                            instances_tables.CLOUDLET_TYPE_DISPLAY[
+                                instance_type])
 
         return filtered_instances
@@ -12,7 +12,8 @@
 
 import json
 import logging
-import requests
+import threading
+import time
 
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
@@ -22,28 +23,29 @@ from django.views.decorators.debug import sensitive_variables
 
 from horizon import exceptions
 from horizon import forms
+from horizon import messages
 from horizon import workflows
 
 from openstack_dashboard import api
 from openstack_dashboard.api import base
-from openstack_dashboard.api import glance
 from openstack_dashboard.usage import quotas
 
-from openstack_dashboard.dashboards.project.cloudlet import cloudlet_api
+from openstack_dashboard.dashboards.project.cloudlet import catalog
+from openstack_dashboard.dashboards.project.cloudlet import jobs
+from openstack_dashboard.dashboards.project.cloudlet import overlay_cache
 from openstack_dashboard.dashboards.project.cloudlet import utils
 from openstack_dashboard.dashboards.project.instances \
     import utils as instance_utils
 
 from elijah.provisioning.configuration import Const as Cloudlet_Const
-from elijah.provisioning.package import VMOverlayPackage
-try:
-    from elijah.provisioning import msgpack
-except ImportError as e:
-    import msgpack
+from novaclient import exceptions as nova_exceptions
 
 
 LOG = logging.getLogger(__name__)
 
+# Seconds between the checks whether a synthesized instance is built.
+SERVER_POLL_INTERVAL = 10
+
 
 class SelectProjectUserAction(workflows.Action):
     project_id = forms.ThemableChoiceField(label=_("Project"))
@@ -113,7 +115,7 @@ class SetResumeDetailAction(workflows.Action):
                       "status": "active"}
 
             try:
-                images, _more, _prev = glance.image_list_detailed(
+                images, _more, _prev = catalog.image_list_detailed(
                     request, filters=public)
                 [public_images.append(image) for image in images]
                 images_cache['public_images'] = public_images
@@ -130,7 +132,7 @@ class SetResumeDetailAction(workflows.Action):
             owner = {"property-owner_id": project_id,
                      "status": "active"}
             try:
-                owned_images, _more, _prev = glance.image_list_detailed(
+                owned_images, _more, _prev = catalog.image_list_detailed(
                     request, filters=owner)
                 images_by_project[project_id] = owned_images
             except Exception:
@@ -177,7 +179,7 @@ class SetResumeDetailAction(workflows.Action):
         # return all flavors of Base VM image
         try:
             matching_flavors = set()
-            flavors = api.nova.flavor_list(request)
+            flavors = catalog.flavor_list(request)
             basevm_images = self._get_available_images(request, context)
             for basevm_image in basevm_images:
                 if basevm_image.properties is None or \
@@ -211,7 +213,7 @@ class SetResumeDetailAction(workflows.Action):
             extra['usages'] = quotas.tenant_quota_usages(self.request)
             extra['usages_json'] = json.dumps(extra['usages'])
             flavors = json.dumps([f._info for f in
-                                  api.nova.flavor_list(self.request)])
+                                  catalog.flavor_list(self.request)])
             extra['flavors'] = flavors
         except Exception:
             exceptions.handle(self.request,
@@ -438,6 +440,7 @@ class ResumeInstance(workflows.Workflow):
                                    dev_mapping,
                                    nics=nics,
                                    instance_count=1,)
+            catalog.invalidate(catalog.IMAGES)
             return True
         except:
             exceptions.handle(request)
@@ -445,10 +448,32 @@ class ResumeInstance(workflows.Workflow):
 
 
 class SetSynthesizeDetailsAction(workflows.Action):
-    overlay_url = forms.CharField(max_length=200,
-                                  required=True,
-                                  label=_("URL for VM overlay"),
-                                  initial="http://")
+    source_type = forms.ChoiceField(
+        label=_("VM overlay Source"),
+        required=False,
+        choices=[('url', _("URL")),
+                 ('image', _("VM overlay image"))],
+        widget=forms.ThemableSelectWidget(attrs={
+            'class': 'switchable',
+            'data-slug': 'overlaysource'}))
+
+    overlay_url = forms.CharField(
+        max_length=200,
+        required=False,
+        label=_("URL for VM overlay"),
+        initial="http://",
+        widget=forms.TextInput(attrs={
+            'class': 'switched',
+            'data-switch-on': 'overlaysource',
+            'data-overlaysource-url': _("URL for VM overlay")}))
+
+    overlay_image_id = forms.ChoiceField(
+        label=_("VM overlay"),
+        required=False,
+        widget=forms.ThemableSelectWidget(attrs={
+            'class': 'switched',
+            'data-switch-on': 'overlaysource',
+            'data-overlaysource-image': _("VM overlay")}))
 
     name = forms.CharField(max_length=80,
                            label=_("Instance Name"),
@@ -463,11 +488,22 @@ class SetSynthesizeDetailsAction(workflows.Action):
         help_text_template = ("project/cloudlet/instance/"
                               "_synthesis_details_help.html")
 
+    def __init__(self, request, *args, **kwargs):
+        super(SetSynthesizeDetailsAction, self).__init__(request,
+                                                         *args, **kwargs)
+        # Compute nodes only get overlay images through the published
+        # overlay cache.
+        if not overlay_cache.is_published():
+            self.fields['source_type'].choices = [('url', _("URL"))]
+
     def clean(self):
         cleaned_data = super(SetSynthesizeDetailsAction, self).clean()
 
+        if cleaned_data.get('source_type') == 'image':
+            return self._clean_overlay_image(cleaned_data)
+
         overlay_url = cleaned_data.get('overlay_url', None)
-        if overlay_url is None:
+        if not overlay_url:
             raise forms.ValidationError(_("Need URL to fetch VM overlay"))
 
         # check url format
@@ -477,30 +513,21 @@ class SetSynthesizeDetailsAction(workflows.Action):
         except ValidationError, e:
             raise forms.ValidationError(_("Malformed URL for VM overlay"))
 
-        # check url accessibility
-        try:
-            header_ret = requests.head(overlay_url)
-            if header_ret.ok == False:
-                raise
-        except Exception as e:
-            msg = "URL is not accessible : %s" % overlay_url
-            raise forms.ValidationError(_(msg))
-
         if cleaned_data.get('name', None) is None:
             raise forms.ValidationError(_("Need name for the synthesized VM"))
 
         # finally check the header file of VM overlay
-        # to make sure that associated Base VM exists
+        # to make sure that associated Base VM exists. The metadata is
+        # cached and revalidated with a conditional request.
         matching_image = None
-        # requested_basevm_sha256 = ''
+        requested_basevm_sha256 = None
         try:
-            overlay_package = VMOverlayPackage(overlay_url)
-            metadata = overlay_package.read_meta()
-            overlay_meta = msgpack.unpackb(metadata)
+            overlay_meta = utils.read_overlay_meta(overlay_url)
             requested_basevm_sha256 = overlay_meta.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
-            # matching_image = utils.find_basevm_by_sha256(self.request, requested_basevm_sha256)
-            basevms = utils.BaseVMs()
-            matching_image = basevms.is_exist(self.request, requested_basevm_sha256)
+            matching_image = utils.find_basevm_by_sha256(self.request, requested_basevm_sha256)
+        except utils.OverlayUnavailable:
+            msg = "URL is not accessible : %s" % overlay_url
+            raise forms.ValidationError(_(msg))
         except Exception:
             msg = "Error while finding matching Base VM with %s" % (requested_basevm_sha256)
             raise forms.ValidationError(_(msg))
@@ -513,6 +540,56 @@ class SetSynthesizeDetailsAction(workflows.Action):
             cleaned_data['image_id'] = str(matching_image.id)
             return cleaned_data
 
+    def _clean_overlay_image(self, cleaned_data):
+        # The overlay is in Glance already, its base VM is known from the
+        # image or from the time the overlay was created.
+        overlay_image_id = cleaned_data.get('overlay_image_id', None)
+        if not overlay_image_id:
+            raise forms.ValidationError(_("Select a VM overlay"))
+        if cleaned_data.get('name', None) is None:
+            raise forms.ValidationError(_("Need name for the synthesized VM"))
+
+        try:
+            overlay_image = api.glance.image_get(self.request,
+                                                 overlay_image_id)
+            matching_image = utils.find_overlay_basevm(self.request,
+                                                       overlay_image)
+        except Exception:
+            msg = "Error while finding the Base VM of VM overlay %s" % \
+                  overlay_image_id
+            raise forms.ValidationError(_(msg))
+
+        if matching_image is None:
+            msg = "Cannot find the Base VM of VM overlay %s" % \
+                  overlay_image_id
+            raise forms.ValidationError(_(msg))
+        cleaned_data['image_id'] = str(matching_image.id)
+        # The URL is only known once the overlay is in the overlay cache,
+        # see synthesize_overlay_image.
+        cleaned_data['overlay_url'] = None
+        return cleaned_data
+
+    def populate_overlay_image_id_choices(self, request, context):
+        try:
+            filters = utils.cloudlet_image_filters(
+                'cloudlet_overlay', owner=context.get('project_id'))
+            filters['status'] = 'active'
+            images, _more, _prev = catalog.image_list_detailed(
+                request, filters=filters)
+        except Exception:
+            images = []
+            exceptions.handle(request,
+                              _("Unable to retrieve VM overlays."))
+        # Glance may ignore the property filter.
+        choices = [(image.id, image.name) for image in images
+                   if (getattr(image, 'properties', None) or {}).get(
+                       'cloudlet_type') == 'cloudlet_overlay']
+        if choices:
+            choices.insert(0, ("", _("Select VM overlay")))
+        else:
+            choices.insert(0, ("", _("No VM overlay is available.")))
+        return choices
+
     def _get_available_images(self, request, context):
         if not hasattr(self, '_images_cache'):
             images_cache = {}
@@ -527,7 +604,7 @@ class SetSynthesizeDetailsAction(workflows.Action):
                       "status": "active"}
 
             try:
-                images, _more, _prev = glance.image_list_detailed(
+                images, _more, _prev = catalog.image_list_detailed(
                     request, filters=public)
                 [public_images.append(image) for image in images]
                 images_cache['public_images'] = public_images
@@ -544,7 +621,7 @@ class SetSynthesizeDetailsAction(workflows.Action):
             owner = {"property-owner_id": project_id,
                      "status": "active"}
             try:
-                owned_images, _more, _prev = glance.image_list_detailed(
+                owned_images, _more, _prev = catalog.image_list_detailed(
                     request, filters=owner)
                 images_by_project[project_id] = owned_images
             except Exception:
@@ -580,7 +657,7 @@ class SetSynthesizeDetailsAction(workflows.Action):
         # return all flavors of Base VM image
         try:
             matching_flavors = set()
-            flavors = api.nova.flavor_list(request)
+            flavors = catalog.flavor_list(request)
             basevm_images = self._get_available_images(request, context)
             for basevm_image in basevm_images:
                 if basevm_image.properties is None or \
@@ -614,7 +691,7 @@ class SetSynthesizeDetailsAction(workflows.Action):
             extra['usages'] = quotas.tenant_quota_usages(self.request)
             extra['usages_json'] = json.dumps(extra['usages'])
             flavors = json.dumps([f._info for f in
-                                  api.nova.flavor_list(self.request)])
+                                  catalog.flavor_list(self.request)])
             extra['flavors'] = flavors
         except:
             exceptions.handle(self.request,
@@ -624,7 +701,8 @@ class SetSynthesizeDetailsAction(workflows.Action):
 
 class SetSynthesizeAction(workflows.Step):
     action_class = SetSynthesizeDetailsAction
-    contributes = ("image_id", "overlay_url", "name", "flavor")
+    contributes = ("image_id", "source_type", "overlay_url",
+                   "overlay_image_id", "name", "flavor")
 
 
 class SynthesisInstance(workflows.Workflow):
@@ -673,6 +751,14 @@ class SynthesisInstance(workflows.Workflow):
                 nics = []
             nics.extend([{'port-id': port} for port in ports])
 
+        if context.get('source_type') == 'image':
+            return self._start_synthesis_job(
+                request, context,
+                (context['image_id'], context['flavor'],
+                 context['keypair_id'], user_script,
+                 context['security_group_ids'], dev_mapping),
+                {'nics': nics, 'instance_count': 1})
+
         meta = {"overlay_url": context['overlay_url']}
         try:
             api.nova.server_create(request,
@@ -686,7 +772,112 @@ class SynthesisInstance(workflows.Workflow):
                                    nics=nics,
                                    instance_count=1,
                                    meta=meta)
+            catalog.invalidate(catalog.IMAGES)
             return True
         except:
             exceptions.handle(request)
             return False
+
+    def _start_synthesis_job(self, request, context, server_args,
+                             server_kwargs):
+        # Caching the overlay takes as long as downloading it, so the
+        # instance is launched by a background job.
+        try:
+            jobs.check_token(request,
+                             jobs.get_config()['min_token_lifetime'])
+        except jobs.TokenExpired:
+            messages.error(request, _('Your session expires soon, log in '
+                                      'again to synthesize from a VM '
+                                      'overlay image.'))
+            return False
+        try:
+            store = jobs.get_store()
+            job_id = store.create(request.user.tenant_id,
+                                  jobs.SYNTHESIZE_OVERLAY, context['name'])
+            jobs.submit(synthesize_overlay_image, request, job_id,
+                        context['overlay_image_id'], context['name'],
+                        server_args, server_kwargs)
+        except Exception:
+            exceptions.handle(request)
+            return False
+        self.success_message = _('Cloudlet synthesizes %(count)s named '
+                                 '"%(name)s" once its VM overlay is '
+                                 'cached.')
+        return True
+
+
+def _synthesis_error_message(e):
+    if isinstance(e, jobs.TokenExpired):
+        return _('the session expired, log in again and synthesize the '
+                 'instance again')
+    if isinstance(e, utils.OverlayUnavailable):
+        return _('unable to put the VM overlay in the overlay cache')
+    return _('unable to launch the instance')
+
+
+def synthesize_overlay_image(request, job_id, overlay_image_id, name,
+                             server_args, server_kwargs):
+    """Synthesize an instance from a VM overlay image, run as a background job.
+
+    The overlay is put in the overlay cache, then the instance is launched
+    with the signed URL of the cache entry. The entry stays pinned until
+    the instance left the BUILD state or the URL expired. The stage and
+    outcome are recorded in the job table. Returns the instance ID, or
+    None when the synthesis failed.
+    """
+    store = jobs.get_store()
+    pin = None
+    try:
+        jobs.check_token(request, 60)
+        expires = time.time() + overlay_cache.get_config()['public_url_ttl']
+        image = api.glance.image_get(request, overlay_image_id)
+        store.update(job_id, stage=jobs.STAGE_CACHING,
+                     bytes_total=getattr(image, 'size', None) or 0)
+        progress = jobs.ProgressReporter(store, job_id)
+        pin, overlay_url = utils.share_overlay_image(request, image, expires,
+                                                     progress)
+        progress.flush()
+        jobs.check_token(request)
+        store.update(job_id, stage=jobs.STAGE_LAUNCHING)
+        server = api.nova.server_create(request, name, *server_args,
+                                        meta={'overlay_url': overlay_url},
+                                        **server_kwargs)
+        catalog.invalidate(catalog.IMAGES)
+        store.finish(job_id)
+    except Exception as e:
+        LOG.exception("VM synthesis job %s failed", job_id)
+        if pin is not None:
+            _unpin(pin)
+        store.fail(job_id, unicode(_synthesis_error_message(e)))
+        return None
+    watcher = threading.Thread(target=_unpin_when_built,
+                               args=(request, server.id, pin, expires))
+    watcher.daemon = True
+    watcher.start()
+    return server.id
+
+
+def _unpin_when_built(request, server_id, pin, until):
+    # The compute node has fetched the overlay once the instance left the
+    # BUILD state. The pin expires by itself if this thread goes away.
+    try:
+        while time.time() < until:
+            time.sleep(SERVER_POLL_INTERVAL)
+            try:
+                server = api.nova.server_get(request, server_id)
+            except nova_exceptions.NotFound:
+                break
+            except Exception:
+                LOG.debug("Unable to check instance %s", server_id,
+                          exc_info=True)
+                continue
+            if server.status != 'BUILD':
+                break
+    finally:
+        _unpin(pin)
+
+
+def _unpin(pin):
+    cache = overlay_cache.get_cache()
+    if cache is not None:
+        cache.unpin(pin)